@@ -199,16 +199,48 @@ class DeDRM(FileTypePlugin):
             traceback.print_exc()
             raise
 
+    def adeptKeys(self, dedrmprefs, useruuid):
+        # Try the keys recorded for the user the book was issued to first,
+        # then keys for an unknown user, then those known to be another user's.
+        keyuuids = dedrmprefs['adeptkeyuuids']
+        def rank(item):
+            keyuuid = keyuuids.get(item[1])
+            if useruuid is None or keyuuid is None:
+                return 1
+            return 0 if keyuuid == useruuid else 2
+        return sorted(dedrmprefs['adeptkeys'].items(), key=rank)
+
+    def defaultAdeptKeys(self, dedrmprefs):
+        # the default Adobe keys, with the user UUID each belongs to if known
+        if iswindows or isosx:
+            from calibre_plugins.dedrm.adobekey import adeptuserkeys
+
+            return adeptuserkeys()
+        # linux
+        from .wineutils import WineGetKeys
+
+        scriptpath = os.path.join(self.alfdir,"adobekey.py")
+        return [(keyvalue, None) for keyvalue in WineGetKeys(scriptpath, ".der",dedrmprefs['adobewineprefix'])]
+
+    def saveAdeptUser(self, dedrmprefs, userkeyhex, useruuid):
+        # remember which user a key belongs to once a book shows it
+        if useruuid is None or dedrmprefs['adeptkeyuuids'].get(userkeyhex) == useruuid:
+            return
+        try:
+            dedrmprefs['adeptkeyuuids'][userkeyhex] = useruuid
+            dedrmprefs.writeprefs()
+        except:
+            traceback.print_exc()
+
     def ePubDecrypt(self,path_to_ebook):
-        # Create a TemporaryPersistent file to work with.
         # Check original epub archive for zip errors.
-        import calibre_plugins.dedrm.zipfix
+        # The decryptors read the book through zipfix's tolerant reader,
+        # so it is repaired as it is decrypted rather than rewritten first.
+        import calibre_plugins.dedrm.zipfix as zipfix
 
-        inf = self.temporary_file(".epub")
         try:
             print("{0} v{1}: Verifying zip archive integrity".format(PLUGIN_NAME, PLUGIN_VERSION))
-            fr = zipfix.fixZip(path_to_ebook, inf.name)
-            fr.fix()
+            zipfix.TolerantZipFile(path_to_ebook).close()
         except Exception as e:
             print("{0} v{1}: Error \'{2}\' when checking zip archive".format(PLUGIN_NAME, PLUGIN_VERSION, e.args[0]))
             raise Exception(e)
@@ -222,7 +254,7 @@ class DeDRM(FileTypePlugin):
 
 
         #check the book
-        if  ignobleepub.ignobleBook(inf.name):
+        if  ignobleepub.ignobleBook(path_to_ebook):
             print("{0} v{1}: “{2}” is a secure Barnes & Noble ePub".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook)))
 
             # Attempt to decrypt epub with each encryption key (generated or provided).
@@ -233,7 +265,7 @@ class DeDRM(FileTypePlugin):
 
                 # Give the user key, ebook and TemporaryPersistent file to the decryption function.
                 try:
-                    result = ignobleepub.decryptBook(userkey, inf.name, of.name)
+                    result = ignobleepub.decryptBook(userkey, path_to_ebook, of.name)
                 except:
                     print("{0} v{1}: Exception when trying to decrypt after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                     traceback.print_exc()
@@ -283,7 +315,7 @@ class DeDRM(FileTypePlugin):
 
                         # Give the user key, ebook and TemporaryPersistent file to the decryption function.
                         try:
-                            result = ignobleepub.decryptBook(userkey, inf.name, of.name)
+                            result = ignobleepub.decryptBook(userkey, path_to_ebook, of.name)
                         except:
                            print("{0} v{1}: Exception when trying to decrypt after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                            traceback.print_exc()
@@ -315,18 +347,19 @@ class DeDRM(FileTypePlugin):
         # import the Adobe Adept ePub handler
         import calibre_plugins.dedrm.ineptepub as ineptepub
 
-        if ineptepub.adeptBook(inf.name):
+        if ineptepub.adeptBook(path_to_ebook):
             print("{0} v{1}: {2} is a secure Adobe Adept ePub".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook)))
+            useruuid = ineptepub.adeptUserUUID(path_to_ebook)
 
             # Attempt to decrypt epub with each encryption key (generated or provided).
-            for keyname, userkeyhex in dedrmprefs['adeptkeys'].items():
+            for keyname, userkeyhex in self.adeptKeys(dedrmprefs, useruuid):
                 userkey = codecs.decode(userkeyhex, 'hex')
                 print("{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
                 of = self.temporary_file(".epub")
 
                 # Give the user key, ebook and TemporaryPersistent file to the decryption function.
                 try:
-                    result = ineptepub.decryptBook(userkey, inf.name, of.name)
+                    result = ineptepub.decryptBook(userkey, path_to_ebook, of.name)
                 except:
                     print("{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                     traceback.print_exc()
@@ -341,6 +374,7 @@ class DeDRM(FileTypePlugin):
                     # Decryption was successful.
                     # Return the modified PersistentTemporary file to calibre.
                     print("{0} v{1}: Decrypted with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
+                    self.saveAdeptUser(dedrmprefs, userkeyhex, useruuid)
                     return of.name
 
                 print("{0} v{1}: Failed to decrypt with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
@@ -352,36 +386,29 @@ class DeDRM(FileTypePlugin):
             defaultkeys = []
 
             try:
-                if iswindows or isosx:
-                    from calibre_plugins.dedrm.adobekey import adeptkeys
-
-                    defaultkeys = adeptkeys()
-                else: # linux
-                    from .wineutils import WineGetKeys
-
-                    scriptpath = os.path.join(self.alfdir,"adobekey.py")
-                    defaultkeys = WineGetKeys(scriptpath, ".der",dedrmprefs['adobewineprefix'])
-
-                self.default_key = defaultkeys[0]
+                defaultkeys = self.defaultAdeptKeys(dedrmprefs)
+                self.default_key = defaultkeys[0][0]
             except:
                 print("{0} v{1}: Exception when getting default Adobe Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                 traceback.print_exc()
                 self.default_key = ""
 
             newkeys = []
-            for keyvalue in defaultkeys:
+            for keyvalue, keyuuid in defaultkeys:
                 if codecs.encode(keyvalue, 'hex').decode('ascii') not in dedrmprefs['adeptkeys'].values():
-                    newkeys.append(keyvalue)
+                    newkeys.append((keyvalue, keyuuid))
+            # the default key activated for the book's user goes first
+            newkeys.sort(key=lambda newkey: useruuid is None or newkey[1] != useruuid)
 
             if len(newkeys) > 0:
                 try:
-                    for i,userkey in enumerate(newkeys):
+                    for userkey, keyuuid in newkeys:
                         print("{0} v{1}: Trying a new default key".format(PLUGIN_NAME, PLUGIN_VERSION))
                         of = self.temporary_file(".epub")
 
                         # Give the user key, ebook and TemporaryPersistent file to the decryption function.
                         try:
-                            result = ineptepub.decryptBook(userkey, inf.name, of.name)
+                            result = ineptepub.decryptBook(userkey, path_to_ebook, of.name)
                         except:
                             print("{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
                             traceback.print_exc()
@@ -394,8 +421,10 @@ class DeDRM(FileTypePlugin):
                             # Store the new successful key in the defaults
                             print("{0} v{1}: Saving a new default key".format(PLUGIN_NAME, PLUGIN_VERSION))
                             try:
-                                dedrmprefs.addnamedvaluetoprefs('adeptkeys','default_key',codecs.encode(keyvalue, 'hex').decode('ascii'))
+                                userkeyhex = codecs.encode(userkey, 'hex').decode('ascii')
+                                dedrmprefs.addnamedvaluetoprefs('adeptkeys','default_key',userkeyhex)
                                 dedrmprefs.writeprefs()
+                                self.saveAdeptUser(dedrmprefs, userkeyhex, keyuuid or useruuid)
                                 print("{0} v{1}: Saved a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
                             except:
                                 print("{0} v{1}: Exception when saving a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
@@ -421,94 +450,80 @@ class DeDRM(FileTypePlugin):
 
     def PDFDecrypt(self,path_to_ebook):
         import calibre_plugins.dedrm.prefs as prefs
-        import calibre_plugins.dedrm.ineptpdf
+        import calibre_plugins.dedrm.ineptpdf as ineptpdf
 
         dedrmprefs = prefs.DeDRM_Prefs()
         # Attempt to decrypt epub with each encryption key (generated or provided).
         print("{0} v{1}: {2} is a PDF ebook".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook)))
-        for keyname, userkeyhex in dedrmprefs['adeptkeys'].items():
-            userkey = codecs.decode(userkeyhex,'hex')
-            print("{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
-            of = self.temporary_file(".pdf")
-
-            # Give the user key, ebook and TemporaryPersistent file to the decryption function.
-            try:
-                result = ineptpdf.decryptBook(userkey, path_to_ebook, of.name)
-            except:
-                print("{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
-                traceback.print_exc()
-                result = 1
+        # (hex key, uuid, is a new default key) for each key handed out
+        tried = []
 
-            of.close()
-
-            if  result == 0:
-                # Decryption was successful.
-                # Return the modified PersistentTemporary file to calibre.
-                return of.name
+        def userkeys(useruuid):
+            for keyname, userkeyhex in self.adeptKeys(dedrmprefs, useruuid):
+                print("{0} v{1}: Trying Encryption key {2:s}".format(PLUGIN_NAME, PLUGIN_VERSION, keyname))
+                tried.append((userkeyhex, useruuid, False))
+                yield codecs.decode(userkeyhex,'hex')
+                print("{0} v{1}: Failed to decrypt with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
 
-            print("{0} v{1}: Failed to decrypt with key {2:s} after {3:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,keyname,time.time()-self.starttime))
+            # perhaps we need to get a new default ADE key
+            print("{0} v{1}: Looking for new default Adobe Digital Editions Keys after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
 
-        # perhaps we need to get a new default ADE key
-        print("{0} v{1}: Looking for new default Adobe Digital Editions Keys after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
+            # get the default Adobe keys
+            defaultkeys = []
 
-        # get the default Adobe keys
-        defaultkeys = []
+            try:
+                defaultkeys = self.defaultAdeptKeys(dedrmprefs)
+                self.default_key = defaultkeys[0][0]
+            except:
+                print("{0} v{1}: Exception when getting default Adobe Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
+                traceback.print_exc()
+                self.default_key = ""
 
+            newkeys = []
+            for keyvalue, keyuuid in defaultkeys:
+                if codecs.encode(keyvalue,'hex').decode('ascii') not in dedrmprefs['adeptkeys'].values():
+                    newkeys.append((keyvalue, keyuuid))
+            # the default key activated for the book's user goes first
+            newkeys.sort(key=lambda newkey: useruuid is None or newkey[1] != useruuid)
+
+            for userkey, keyuuid in newkeys:
+                print("{0} v{1}: Trying a new default key".format(PLUGIN_NAME, PLUGIN_VERSION))
+                tried.append((codecs.encode(userkey,'hex').decode('ascii'), keyuuid or useruuid, True))
+                yield userkey
+                print("{0} v{1}: Failed to decrypt with new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
+
+        of = self.temporary_file(".pdf")
+
+        # The book is parsed just once, and each key tried on it in turn
+        # until one opens it, those for the book's user first. Give the
+        # keys, ebook and TemporaryPersistent file to the decryption function.
         try:
-            if iswindows or isosx:
-                from calibre_plugins.dedrm.adobekey import adeptkeys
-
-                defaultkeys = adeptkeys()
-            else: # linux
-                from .wineutils import WineGetKeys
-
-                scriptpath = os.path.join(self.alfdir,"adobekey.py")
-                defaultkeys = WineGetKeys(scriptpath, ".der",dedrmprefs['adobewineprefix'])
-
-            self.default_key = defaultkeys[0]
+            result, userkey = ineptpdf.decryptBookWithKeys(userkeys, path_to_ebook, of.name)
         except:
-            print("{0} v{1}: Exception when getting default Adobe Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
+            print("{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
             traceback.print_exc()
-            self.default_key = ""
-
-        newkeys = []
-        for keyvalue in defaultkeys:
-            if codecs.encode(keyvalue,'hex') not in dedrmprefs['adeptkeys'].values():
-                newkeys.append(keyvalue)
-
-        if len(newkeys) > 0:
-            try:
-                for i,userkey in enumerate(newkeys):
-                    print("{0} v{1}: Trying a new default key".format(PLUGIN_NAME, PLUGIN_VERSION))
-                    of = self.temporary_file(".pdf")
-
-                    # Give the user key, ebook and TemporaryPersistent file to the decryption function.
-                    try:
-                        result = ineptpdf.decryptBook(userkey, path_to_ebook, of.name)
-                    except:
-                        print("{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
-                        traceback.print_exc()
-                        result = 1
-
-                    of.close()
+            result = 1
 
-                    if  result == 0:
-                        # Decryption was a success
-                        # Store the new successful key in the defaults
-                        print("{0} v{1}: Saving a new default key".format(PLUGIN_NAME, PLUGIN_VERSION))
-                        try:
-                            dedrmprefs.addnamedvaluetoprefs('adeptkeys','default_key',codecs.encode(keyvalue,'hex'))
-                            dedrmprefs.writeprefs()
-                            print("{0} v{1}: Saved a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
-                        except:
-                            print("{0} v{1}: Exception when saving a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
-                            traceback.print_exc()
-                        # Return the modified PersistentTemporary file to calibre.
-                        return of.name
+        of.close()
 
-                    print("{0} v{1}: Failed to decrypt with new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
-            except Exception as e:
-                pass
+        if  result == 0:
+            # Decryption was successful.
+            userkeyhex, keyuuid, newkey = tried[-1]
+            if newkey:
+                # Store the new successful key in the defaults
+                print("{0} v{1}: Saving a new default key".format(PLUGIN_NAME, PLUGIN_VERSION))
+                try:
+                    dedrmprefs.addnamedvaluetoprefs('adeptkeys','default_key',userkeyhex)
+                    dedrmprefs.writeprefs()
+                    self.saveAdeptUser(dedrmprefs, userkeyhex, keyuuid)
+                    print("{0} v{1}: Saved a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
+                except:
+                    print("{0} v{1}: Exception when saving a new default key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime))
+                    traceback.print_exc()
+            else:
+                self.saveAdeptUser(dedrmprefs, userkeyhex, keyuuid)
+            # Return the modified PersistentTemporary file to calibre.
+            return of.name
 
         # Something went wrong with decryption.
         print("{0} v{1}: Ultimately failed to decrypt after {2:.1f} seconds. Read the FAQs at Harper's repository: https://github.com/apprenticeharper/DeDRM_tools/blob/master/FAQs.md".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
@@ -627,6 +642,11 @@ class DeDRM(FileTypePlugin):
         print("{0} v{1}: Trying to decrypt {2}".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook)))
         self.starttime = time.time()
 
+        # choose how the decrypted archives are compressed
+        import calibre_plugins.dedrm.prefs as prefs
+        import calibre_plugins.dedrm.ziputils as ziputils
+        ziputils.setpolicy(ziputils.CompressionPolicy(fast=prefs.DeDRM_Prefs()['fastcompression']))
+
         booktype = os.path.splitext(path_to_ebook)[1].lower()[1:]
         if booktype in ['prc','mobi','pobi','azw','azw1','azw3','azw4','tpz','kfx-zip']:
             # Kindle/Mobipocket
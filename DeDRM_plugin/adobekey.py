@@ -29,13 +29,14 @@
 #   5.9 - moved unicode_argv call inside main for Windows DeDRM compatibility
 #   6.0 - Work if TkInter is missing
 #   7.0 - Python 3 for calibre 5
+#   7.1 - Report the user UUID each key was activated for
 
 """
 Retrieve Adobe ADEPT user key.
 """
 
 __license__ = 'GPL v3'
-__version__ = '7.0'
+__version__ = '7.1'
 
 import sys, os, struct, getopt
 from base64 import b64decode
@@ -344,7 +345,7 @@ if iswindows:
         return CryptUnprotectData
     CryptUnprotectData = CryptUnprotectData()
 
-    def adeptkeys():
+    def adeptuserkeys():
         if AES is None:
             raise ADEPTError("PyCrypto or OpenSSL must be installed")
         root = GetSystemDirectory().split('\\')[0] + '\\'
@@ -374,12 +375,17 @@ if iswindows:
             ktype = winreg.QueryValueEx(plkparent, None)[0]
             if ktype != 'credentials':
                 continue
+            uuid = None
+            plkkeys = []
             for j in range(0, 16):
                 try:
                     plkkey = winreg.OpenKey(plkparent, "%04d" % (j,))
                 except WindowsError:
                     break
                 ktype = winreg.QueryValueEx(plkkey, None)[0]
+                if ktype == 'user':
+                    uuid = winreg.QueryValueEx(plkkey, 'value')[0]
+                    continue
                 if ktype != 'privateLicenseKey':
                     continue
                 userkey = winreg.QueryValueEx(plkkey, 'value')[0]
@@ -388,7 +394,9 @@ if iswindows:
                 userkey = aes.decrypt(userkey)
                 userkey = userkey[26:-ord(userkey[-1:])]
                 #print "found key:",userkey.encode('hex')
-                keys.append(userkey)
+                plkkeys.append(userkey)
+            # the user entry may come after the keys it belongs to
+            keys.extend((userkey, uuid) for userkey in plkkeys)
         if len(keys) == 0:
             raise ADEPTError('Could not locate privateLicenseKey')
         print("Found {0:d} keys".format(len(keys)))
@@ -424,7 +432,7 @@ elif isosx:
             return ActDatPath
         return None
 
-    def adeptkeys():
+    def adeptuserkeys():
         actpath = findActivationDat()
         if actpath is None:
             raise ADEPTError("Could not find ADE activation.dat file.")
@@ -434,25 +442,33 @@ elif isosx:
         userkey = tree.findtext(expr)
         userkey = b64decode(userkey)
         userkey = userkey[26:]
-        return [userkey]
+        expr = '//%s/%s' % (adept('credentials'), adept('user'))
+        uuid = tree.findtext(expr)
+        return [(userkey, uuid)]
 
 else:
-    def adeptkeys():
+    def adeptuserkeys():
         raise ADEPTError("This script only supports Windows and Mac OS X.")
         return []
 
+# adeptuserkeys() pairs each key with the user UUID (urn:uuid:...) it was
+# activated for, or None where the activation doesn't record it
+def adeptkeys():
+    return [userkey for userkey, uuid in adeptuserkeys()]
+
 # interface for Python DeDRM
 def getkey(outpath):
-    keys = adeptkeys()
+    keys = adeptuserkeys()
     if len(keys) > 0:
         if not os.path.isdir(outpath):
             outfile = outpath
+            key, uuid = keys[0]
             with open(outfile, 'wb') as keyfileout:
-                keyfileout.write(keys[0])
-            print("Saved a key to {0}".format(outfile))
+                keyfileout.write(key)
+            print("Saved a key{0} to {1}".format(foruser(uuid),outfile))
         else:
             keycount = 0
-            for key in keys:
+            for key, uuid in keys:
                 while True:
                     keycount += 1
                     outfile = os.path.join(outpath,"adobekey_{0:d}.der".format(keycount))
@@ -460,10 +476,15 @@ def getkey(outpath):
                         break
                 with open(outfile, 'wb') as keyfileout:
                     keyfileout.write(key)
-                print("Saved a key to {0}".format(outfile))
+                print("Saved a key{0} to {1}".format(foruser(uuid),outfile))
         return True
     return False
 
+def foruser(uuid):
+    if uuid is None:
+        return ""
+    return " for user {0}".format(uuid)
+
 def usage(progname):
     print("Finds, decrypts and saves the default Adobe Adept encryption key(s).")
     print("Keys are saved to the current directory, or a specified output directory.")
@@ -10,7 +10,7 @@ import os, traceback, json, codecs
 
 from PyQt5.Qt import (Qt, QWidget, QHBoxLayout, QVBoxLayout, QLabel, QLineEdit,
                       QGroupBox, QPushButton, QListWidget, QListWidgetItem,
-                      QAbstractItemView, QIcon, QDialog, QDialogButtonBox, QUrl)
+                      QAbstractItemView, QIcon, QDialog, QDialogButtonBox, QUrl, QCheckBox)
 
 from PyQt5 import Qt as QtGui
 from zipfile import ZipFile
@@ -43,6 +43,7 @@ class ConfigWidget(QWidget):
         self.tempdedrmprefs = {}
         self.tempdedrmprefs['bandnkeys'] = self.dedrmprefs['bandnkeys'].copy()
         self.tempdedrmprefs['adeptkeys'] = self.dedrmprefs['adeptkeys'].copy()
+        self.tempdedrmprefs['adeptkeyuuids'] = self.dedrmprefs['adeptkeyuuids'].copy()
         self.tempdedrmprefs['ereaderkeys'] = self.dedrmprefs['ereaderkeys'].copy()
         self.tempdedrmprefs['kindlekeys'] = self.dedrmprefs['kindlekeys'].copy()
         self.tempdedrmprefs['androidkeys'] = self.dedrmprefs['androidkeys'].copy()
@@ -50,6 +51,7 @@ class ConfigWidget(QWidget):
         self.tempdedrmprefs['serials'] = list(self.dedrmprefs['serials'])
         self.tempdedrmprefs['adobewineprefix'] = self.dedrmprefs['adobewineprefix']
         self.tempdedrmprefs['kindlewineprefix'] = self.dedrmprefs['kindlewineprefix']
+        self.tempdedrmprefs['fastcompression'] = self.dedrmprefs['fastcompression']
 
         # Start Qt Gui dialog layout
         layout = QVBoxLayout(self)
@@ -108,6 +110,11 @@ class ConfigWidget(QWidget):
         button_layout.addWidget(self.adept_button)
         button_layout.addWidget(self.kindle_key_button)
 
+        self.fast_compression_checkbox = QCheckBox(_("Compress decrypted books faster, making larger files"), self)
+        self.fast_compression_checkbox.setToolTip(_("Deflate the members of rewritten EPUB, KFX-ZIP and HTMLZ files at the fastest level"))
+        self.fast_compression_checkbox.setChecked(self.tempdedrmprefs['fastcompression'])
+        layout.addWidget(self.fast_compression_checkbox)
+
         self.resize(self.sizeHint())
 
     def kindle_serials(self):
@@ -162,6 +169,7 @@ class ConfigWidget(QWidget):
     def save_settings(self):
         self.dedrmprefs.set('bandnkeys', self.tempdedrmprefs['bandnkeys'])
         self.dedrmprefs.set('adeptkeys', self.tempdedrmprefs['adeptkeys'])
+        self.dedrmprefs.set('adeptkeyuuids', self.tempdedrmprefs['adeptkeyuuids'])
         self.dedrmprefs.set('ereaderkeys', self.tempdedrmprefs['ereaderkeys'])
         self.dedrmprefs.set('kindlekeys', self.tempdedrmprefs['kindlekeys'])
         self.dedrmprefs.set('androidkeys', self.tempdedrmprefs['androidkeys'])
@@ -169,6 +177,7 @@ class ConfigWidget(QWidget):
         self.dedrmprefs.set('serials', self.tempdedrmprefs['serials'])
         self.dedrmprefs.set('adobewineprefix', self.tempdedrmprefs['adobewineprefix'])
         self.dedrmprefs.set('kindlewineprefix', self.tempdedrmprefs['kindlewineprefix'])
+        self.dedrmprefs.set('fastcompression', self.fast_compression_checkbox.isChecked())
         self.dedrmprefs.set('configured', True)
         self.dedrmprefs.writeprefs()
 
@@ -705,18 +714,19 @@ class AddAdeptDialog(QDialog):
         layout = QVBoxLayout(self)
         self.setLayout(layout)
 
+        self.default_uuid = None
         try:
             if iswindows or isosx:
-                from calibre_plugins.dedrm.adobekey import adeptkeys
+                from calibre_plugins.dedrm.adobekey import adeptuserkeys
 
-                defaultkeys = adeptkeys()
+                defaultkeys = adeptuserkeys()
             else:  # linux
                 from .wineutils import WineGetKeys
 
                 scriptpath = os.path.join(parent.parent.alfdir,"adobekey.py")
-                defaultkeys = WineGetKeys(scriptpath, ".der",parent.getwineprefix())
+                defaultkeys = [(key, None) for key in WineGetKeys(scriptpath, ".der",parent.getwineprefix())]
 
-            self.default_key = defaultkeys[0]
+            self.default_key, self.default_uuid = defaultkeys[0]
         except:
             traceback.print_exc()
             self.default_key = ""
@@ -765,6 +775,9 @@ class AddAdeptDialog(QDialog):
         if len(self.key_name) < 4:
             errmsg = "Key name must be at <i>least</i> 4 characters long!"
             return error_dialog(None, "{0} {1}".format(PLUGIN_NAME, PLUGIN_VERSION), errmsg, show=True, show_copy_button=False)
+        if self.default_uuid is not None:
+            # remember whose key this is, so books for that user try it first
+            self.parent.parent.tempdedrmprefs['adeptkeyuuids'][self.key_value.decode('ascii')] = self.default_uuid
         QDialog.accept(self)
 
 
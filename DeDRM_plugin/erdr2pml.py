@@ -64,11 +64,14 @@
 #  0.22 - Unicode and plugin support, different image folders for PMLZ and source
 #  0.23 - moved unicode_argv call inside main for Windows DeDRM compatibility
 #  1.00 - Added Python 3 compatibility for calibre 5.0
+#  1.01 - Pick the DES backend by self test and report it, and decrypt
+#         text records on a pool of threads
 
-__version__='1.00'
+__version__='1.01'
 
 import sys, re
 import struct, binascii, getopt, zlib, os, os.path, urllib, tempfile, traceback
+from concurrent.futures import ThreadPoolExecutor
 
 if 'calibre' in sys.modules:
     inCalibre = True
@@ -131,51 +134,41 @@ def unicode_argv():
         argvencoding = sys.stdin.encoding or "utf-8"
         return [arg if isinstance(arg, str) else str(arg, argvencoding) for arg in sys.argv]
 
-Des = None
-if iswindows:
-    # first try with pycrypto
-    if inCalibre:
-        from calibre_plugins.dedrm import pycrypto_des
-    else:
-        import pycrypto_des
-    Des = pycrypto_des.load_pycrypto()
-    if Des == None:
-        # they try with openssl
-        if inCalibre:
-            from calibre_plugins.dedrm import openssl_des
-        else:
-            import openssl_des
-        Des = openssl_des.load_libcrypto()
+if inCalibre:
+    from calibre_plugins.dedrm import openssl_des, pycrypto_des, python_des
+    from calibre_plugins.dedrm.ziputils import WORKERS
 else:
-    # first try with openssl
-    if inCalibre:
-        from calibre_plugins.dedrm import openssl_des
-    else:
-        import openssl_des
-    Des = openssl_des.load_libcrypto()
-    if Des == None:
-        # then try with pycrypto
-        if inCalibre:
-            from calibre_plugins.dedrm import pycrypto_des
-        else:
-            import pycrypto_des
-        Des = pycrypto_des.load_pycrypto()
-
-# if that did not work then use pure python implementation
-# of DES and try to speed it up with Psycho
-if Des == None:
-    if inCalibre:
-        from calibre_plugins.dedrm import python_des
-    else:
-        import python_des
-    Des = python_des.Des
-    # Import Psyco if available
-    try:
-        # http://psyco.sourceforge.net
-        import psyco
-        psyco.full()
-    except ImportError:
-        pass
+    import openssl_des, pycrypto_des, python_des
+    from ziputils import WORKERS
+
+# DES implementations, fastest first. The first that loads and passes the
+# self test is used, and DES_BACKEND says which it was.
+DES_LOADERS = (
+    ('PyCryptodome', pycrypto_des.load_pycrypto),
+    ('OpenSSL libcrypto', openssl_des.load_libcrypto),
+    ('pure Python (slow)', lambda: python_des.Des),
+)
+
+def des_selftest(des):
+    # FIPS 81 style known answer, two blocks to check multi-block calls
+    key = binascii.unhexlify(b'133457799bbcdff1')
+    plain = binascii.unhexlify(b'0123456789abcdef')
+    cipher = binascii.unhexlify(b'85e813540f0ab405')
+    return des(key).decrypt(cipher * 2) == plain * 2
+
+def load_des():
+    for name, loader in DES_LOADERS:
+        try:
+            des = loader()
+            if des is not None and des_selftest(des):
+                if getattr(des, 'api', None):
+                    name = '{0} ({1})'.format(name, des.api)
+                return name, des
+        except Exception:
+            pass
+    return None, None
+
+DES_BACKEND, Des = load_des()
 
 try:
     from hashlib import sha1
@@ -243,14 +236,14 @@ def fixKey(key):
     return bytes([fixByte(a) for a in key])
 
 def deXOR(text, sp, table):
-    r=''
+    r = bytearray()
     j = sp
     for i in range(len(text)):
-        r += chr(ord(table[j]) ^ ord(text[i]))
+        r.append(table[j] ^ text[i])
         j = j + 1
         if j == len(table):
             j = 0
-    return r
+    return bytes(r)
 
 class EreaderProcessor(object):
     def __init__(self, sect, user_key):
@@ -403,54 +396,56 @@ class EreaderProcessor(object):
     #     return bkinfo
 
     def getText(self):
-        des = Des(fixKey(self.content_key))
-        r = b''
-        for i in range(self.num_text_pages):
-            logging.debug('get page %d', i)
-            r += zlib.decompress(des.decrypt(self.section_reader(1 + i)))
-
-        # now handle footnotes pages
-        if self.num_footnote_pages > 0:
-            r += '\n'
-            # the record 0 of the footnote section must pass through the Xor Table to make it useful
-            sect = self.section_reader(self.first_footnote_page)
-            fnote_ids = deXOR(sect, 0, self.xortable)
-            # the remaining records of the footnote sections need to be decoded with the content_key and zlib inflated
-            des = Des(fixKey(self.content_key))
-            for i in range(1,self.num_footnote_pages):
-                logging.debug('get footnotepage %d', i)
-                id_len = ord(fnote_ids[2])
-                id = fnote_ids[3:3+id_len]
-                fmarker = '<footnote id="%s">\n' % id
-                fmarker += zlib.decompress(des.decrypt(self.section_reader(self.first_footnote_page + i)))
-                fmarker += '\n</footnote>\n'
-                r += fmarker
-                fnote_ids = fnote_ids[id_len+4:]
-
-        # TODO: Handle dictionary index (?) pages - which are also marked as
-        # sidebar_pages (?). For now dictionary sidebars are ignored
-        # For dictionaries - record 0 is null terminated strings, followed by
-        # blocks of around 62000 bytes and a final block. Not sure of the
-        # encoding
-
-        # now handle sidebar pages
-        if self.num_sidebar_pages > 0:
-            r += '\n'
-            # the record 0 of the sidebar section must pass through the Xor Table to make it useful
-            sect = self.section_reader(self.first_sidebar_page)
-            sbar_ids = deXOR(sect, 0, self.xortable)
-            # the remaining records of the sidebar sections need to be decoded with the content_key and zlib inflated
-            des = Des(fixKey(self.content_key))
-            for i in range(1,self.num_sidebar_pages):
-                id_len = ord(sbar_ids[2])
-                id = sbar_ids[3:3+id_len]
-                smarker = '<sidebar id="%s">\n' % id
-                smarker += zlib.decompress(des.decrypt(self.section_reader(self.first_sidebar_page + i)))
-                smarker += '\n</sidebar>\n'
-                r += smarker
-                sbar_ids = sbar_ids[id_len+4:]
-
-        return r
+        key = fixKey(self.content_key)
+        def decrypt(record):
+            # each thread has its own key schedule
+            logging.debug('get record %d', record)
+            return zlib.decompress(Des(key).decrypt(self.section_reader(record)))
+
+        # The records are decrypted and inflated on a pool of threads, and
+        # all the pieces joined up once at the end.
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            r = list(pool.map(decrypt, range(1, 1 + self.num_text_pages)))
+
+            # now handle footnotes pages
+            if self.num_footnote_pages > 0:
+                r.append(b'\n')
+                # the record 0 of the footnote section must pass through the Xor Table to make it useful
+                sect = self.section_reader(self.first_footnote_page)
+                fnote_ids = deXOR(sect, 0, self.xortable)
+                # the remaining records of the footnote sections need to be decoded with the content_key and zlib inflated
+                records = range(self.first_footnote_page + 1, self.first_footnote_page + self.num_footnote_pages)
+                for fnote in pool.map(decrypt, records):
+                    id_len = fnote_ids[2]
+                    id = fnote_ids[3:3+id_len]
+                    r.append(b'<footnote id="%s">\n' % id)
+                    r.append(fnote)
+                    r.append(b'\n</footnote>\n')
+                    fnote_ids = fnote_ids[id_len+4:]
+
+            # TODO: Handle dictionary index (?) pages - which are also marked as
+            # sidebar_pages (?). For now dictionary sidebars are ignored
+            # For dictionaries - record 0 is null terminated strings, followed by
+            # blocks of around 62000 bytes and a final block. Not sure of the
+            # encoding
+
+            # now handle sidebar pages
+            if self.num_sidebar_pages > 0:
+                r.append(b'\n')
+                # the record 0 of the sidebar section must pass through the Xor Table to make it useful
+                sect = self.section_reader(self.first_sidebar_page)
+                sbar_ids = deXOR(sect, 0, self.xortable)
+                # the remaining records of the sidebar sections need to be decoded with the content_key and zlib inflated
+                records = range(self.first_sidebar_page + 1, self.first_sidebar_page + self.num_sidebar_pages)
+                for sbar in pool.map(decrypt, records):
+                    id_len = sbar_ids[2]
+                    id = sbar_ids[3:3+id_len]
+                    r.append(b'<sidebar id="%s">\n' % id)
+                    r.append(sbar)
+                    r.append(b'\n</sidebar>\n')
+                    sbar_ids = sbar_ids[id_len+4:]
+
+        return b''.join(r)
 
 def cleanPML(pml):
     # Convert special characters to proper PML code.  High ASCII start at (\x80, \a128) and go up to (\xff, \a255)
@@ -474,7 +469,9 @@ def decryptBook(infile, outpath, make_pmlz, user_key):
     try:
         if not os.path.exists(outdir):
             os.makedirs(outdir)
-        print("Decoding File")
+        if Des is None:
+            raise ValueError('no working DES implementation')
+        print("Decoding File, with DES from {0}".format(DES_BACKEND))
         sect  =Sectionizer(infile, b'PNRdPPrs')
         er = EreaderProcessor(sect, user_key)
 
@@ -14,6 +14,7 @@
 # Revision history:
 #  0.1   - Initial alpha testing release 2020 by Pu D. Pud
 #  0.2   - Python 3 for calibre 5.0 (in testing)
+#  0.3   - Parse the document once and try each of a list of keys on it
 
 
 """
@@ -21,7 +22,7 @@ Decrypts Barnes & Noble encrypted PDF files.
 """
 
 __license__ = 'GPL v3'
-__version__ = "0.2"
+__version__ = "0.3"
 
 import sys
 import os
@@ -1803,14 +1804,15 @@ class PDFObjStrmParser(PDFParser):
 ### My own code, for which there is none else to blame
 
 class PDFSerializer(object):
-    def __init__(self, inf, userkey):
+    def __init__(self, inf, userkey=None):
         global GEN_XREF_STM, gen_xref_stm
         gen_xref_stm = GEN_XREF_STM > 1
         self.version = inf.read(8)
         inf.seek(0)
         self.doc = doc = PDFDocument()
         parser = PDFParser(doc, inf)
-        doc.initialize(userkey)
+        if userkey is not None:
+            doc.initialize(userkey)
         self.objids = objids = set()
         for xref in reversed(doc.xrefs):
             trailer = xref.trailer
@@ -1823,6 +1825,21 @@ class PDFSerializer(object):
             objids.remove(trailer.pop('Encrypt').objid)
         self.trailer = trailer
 
+    def initialize(self, userkey):
+        # check userkey against the document's Encrypt dictionary, and
+        # if it opens the document set it up to decrypt with that key.
+        # anything read with an earlier key is deciphered wrongly
+        self.doc.objs.clear()
+        self.doc.parsed_objs.clear()
+        try:
+            self.doc.initialize(userkey)
+        except PDFEncryptionError:
+            raise
+        except Exception as e:
+            print("Key does not open the document: {0}".format(e))
+            return False
+        return True
+
     def dump(self, outf):
         self.outf = outf
         self.write(self.version)
@@ -2000,23 +2017,36 @@ class PDFSerializer(object):
 
 
 def decryptBook(userkey, inpath, outpath):
+    return decryptBookWithKeys([userkey], inpath, outpath)[0]
+
+
+def decryptBookWithKeys(userkeys, inpath, outpath):
+    '''
+    Decrypt inpath into outpath with the first of userkeys that opens it.
+    The document is parsed just once, each key is checked against its
+    Encrypt dictionary in turn, and nothing is written until one fits.
+    If writing fails, the keys after it are tried.
+    Returns the result and the key used, which is None if none fitted.
+    '''
     if AES is None:
         raise IGNOBLEError("PyCrypto or OpenSSL must be installed.")
     with open(inpath, 'rb') as inf:
-        #try:
-        serializer = PDFSerializer(inf, userkey)
-        #except:
-        #    print("Error serializing pdf {0}. Probably wrong key.".format(os.path.basename(inpath)))
-        #    return 2
-        # hope this will fix the 'bad file descriptor' problem
-        with open(outpath, 'wb') as outf:
-            # help construct to make sure the method runs to the end
-            try:
-                serializer.dump(outf)
-            except Exception as e:
-                print("error writing pdf: {0}".format(e.args[0]))
-                return 2
-    return 0
+        serializer = PDFSerializer(inf)
+        result, used = 1, None
+        for userkey in userkeys:
+            if not serializer.initialize(userkey):
+                continue
+            # hope this will fix the 'bad file descriptor' problem
+            with open(outpath, 'wb') as outf:
+                # help construct to make sure the method runs to the end
+                try:
+                    serializer.dump(outf)
+                except Exception as e:
+                    print("error writing pdf: {0}".format(e.args[0]))
+                    result, used = 2, userkey
+                    continue
+            return 0, userkey
+    return result, used
 
 
 def cli_main():
@@ -30,24 +30,43 @@
 #   6.5 - Completely remove erroneous check on DER file sanity
 #   6.6 - Import tkFileDialog, don't assume something else will import it.
 #   7.0 - Add Python 3 compatibility for calibre 5.0
+#   7.1 - Stream encrypted members through AES and inflate a chunk at a time
+#   7.2 - Copy unencrypted members with their compressed bytes untouched
+#   7.3 - Keep the decrypted deflate stream as the compressed member data
+#   7.4 - Decrypt members on a pool of threads, writing them out in order
+#   7.5 - Recompress members by the shared compression policy
+#   7.6 - Read damaged archives through zipfix's tolerant reader
+#   7.7 - Report the user UUID a book's rights were issued to
 
 """
 Decrypt Adobe Digital Editions encrypted ePub books.
 """
 
 __license__ = 'GPL v3'
-__version__ = "7.0"
+__version__ = "7.7"
 
 import codecs
+import collections
 import sys
 import os
 import traceback
 import zlib
 import zipfile
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZipInfo, ZipFile, ZIP_STORED, ZIP_DEFLATED
 from contextlib import closing
 import xml.etree.ElementTree as etree
 
+try:
+    from ziputils import copyrawmember, writerawmember, setchecksum, spoolfile, readchunks
+    from ziputils import DeflateChecksum, WORKERS, getpolicy
+    from zipfix import TolerantZipFile
+except:
+    from calibre_plugins.dedrm.ziputils import copyrawmember, writerawmember, setchecksum, spoolfile, readchunks
+    from calibre_plugins.dedrm.ziputils import DeflateChecksum, WORKERS, getpolicy
+    from calibre_plugins.dedrm.zipfix import TolerantZipFile
+
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
 # encoded using "replace" before writing them.
@@ -190,9 +209,10 @@ def _load_crypto_libcrypto():
             if rv < 0:
                 raise ADEPTError('Failed to initialize AES key')
 
-        def decrypt(self, data):
+        def decrypt(self, data, iv=b"\x00" * 16):
             out = create_string_buffer(len(data))
-            iv = (b"\x00" * self._blocksize)
+            # AES_cbc_encrypt updates the iv in place, so give it a copy
+            iv = create_string_buffer(iv, len(iv))
             rv = AES_cbc_encrypt(data, out, len(data), self._key, iv, 0)
             if rv == 0:
                 raise ADEPTError('AES decryption failed')
@@ -295,10 +315,10 @@ def _load_crypto_pycrypto():
 
     class AES(object):
         def __init__(self, key):
-            self._aes = _AES.new(key, _AES.MODE_CBC, b'\x00'*16)
+            self._key = key
 
-        def decrypt(self, data):
-            return self._aes.decrypt(data)
+        def decrypt(self, data, iv=b'\x00'*16):
+            return _AES.new(self._key, _AES.MODE_CBC, iv).decrypt(data)
 
     class RSA(object):
         def __init__(self, der):
@@ -334,6 +354,9 @@ def _load_crypto():
 AES, RSA = _load_crypto()
 
 META_NAMES = ('mimetype', 'META-INF/rights.xml', 'META-INF/encryption.xml')
+MIMETYPE = b'application/epub+zip'
+# encrypted members are decrypted and inflated this many bytes at a time
+_CHUNK_SIZE = 64 * 1024
 NSMAP = {'adept': 'http://ns.adobe.com/adept',
          'enc': 'http://www.w3.org/2001/04/xmlenc#'}
 
@@ -351,32 +374,83 @@ class Decryptor(object):
                 path = path.encode('utf-8')
                 encrypted.add(path)
 
-    def decompress(self, bytes):
+    def isencrypted(self, path):
+        return path.encode('utf-8') in self._encrypted
+
+    def decryptchunks(self, infile):
+        # yield the decrypted, still deflated, member a chunk at a time.
+        # the first block is the IV, after that the last ciphertext
+        # block of each chunk is carried over as the IV of the next one
+        iv = infile.read(16)
+        held = b''
+        while True:
+            chunk = infile.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            data = held + self._aes.decrypt(chunk, iv)
+            iv = chunk[-16:]
+            # hold back the last block until we know where the padding is
+            held = data[-16:]
+            if len(data) > 16:
+                yield data[:-16]
+
+        if held:
+            yield held[:-held[-1]]
+
+    def decryptstream(self, infile, outfile):
         dc = zlib.decompressobj(-15)
-        try:
-            decompressed_bytes = dc.decompress(bytes)
-            ex = dc.decompress(b'Z') + dc.flush()
-            if ex:
-                decompressed_bytes = decompressed_bytes + ex
-        except:
-            # possibly not compressed by zip - just return bytes
-            return bytes
-        return decompressed_bytes 
-    
+        compressed = True
+        started = False
+        for data in self.decryptchunks(infile):
+            if compressed:
+                try:
+                    data = dc.decompress(data)
+                except zlib.error:
+                    # possibly not compressed by zip - just pass the bytes through
+                    if started:
+                        raise
+                    compressed = False
+            started = True
+            outfile.write(data)
+
+        if compressed:
+            outfile.write(dc.decompress(b'Z') + dc.flush())
+
+    def decryptmember(self, inf, path):
+        # decrypt a member into a spool file, ready to be written out as
+        # the member's compressed data. this runs on a worker thread.
+        spool = spoolfile()
+        with inf.open(path) as infile:
+            try:
+                # the decrypted data is already a deflate stream, so it
+                # is used as the compressed member data as it is
+                check = DeflateChecksum()
+                for data in self.decryptchunks(infile):
+                    spool.write(data)
+                    check.update(data)
+                check.finish()
+            except zlib.error:
+                # not a complete deflate stream, inflate it and then store
+                # or compress it again as the compression policy says
+                spool.seek(0)
+                spool.truncate()
+                infile.seek(0)
+                check = getpolicy().writer(path, spool)
+                self.decryptstream(infile, check)
+                check.finish()
+        spool.seek(0)
+        return spool, check
+
     def decrypt(self, path, data):
-        if path.encode('utf-8') in self._encrypted:
-            data = self._aes.decrypt(data)[16:]
-            if type(data[-1]) != int:
-                place = ord(data[-1])
-            else:
-                place = data[-1]
-            data = data[:-place]
-            data = self.decompress(data)
+        if self.isencrypted(path):
+            outfile = BytesIO()
+            self.decryptstream(BytesIO(data), outfile)
+            data = outfile.getvalue()
         return data
 
 # check file to make check whether it's probably an Adobe Adept encrypted ePub
 def adeptBook(inpath):
-    with closing(ZipFile(open(inpath, 'rb'))) as inf:
+    with closing(TolerantZipFile(open(inpath, 'rb'))) as inf:
         namelist = set(inf.namelist())
         if 'META-INF/rights.xml' not in namelist or \
            'META-INF/encryption.xml' not in namelist:
@@ -393,18 +467,57 @@ def adeptBook(inpath):
             return True
     return False
 
+# the user UUID (urn:uuid:...) the book was fulfilled for, if the rights say
+def adeptUserUUID(inpath):
+    with closing(TolerantZipFile(open(inpath, 'rb'))) as inf:
+        try:
+            rights = etree.fromstring(inf.read('META-INF/rights.xml'))
+            adept = lambda tag: '{%s}%s' % (NSMAP['adept'], tag)
+            expr = './/%s' % (adept('user'),)
+            uuid = rights.findtext(expr)
+            if uuid:
+                return uuid.strip()
+        except:
+            pass
+    return None
+
+def writemember(inf, outf, path, decrypted):
+    if decrypted is None:
+        # nothing to decrypt, so copy the compressed bytes as they are
+        copyrawmember(inf, outf, inf.getinfo(path))
+        return
+
+    spool, check = decrypted.result()
+    zi = ZipInfo(path)
+    try:
+        # get the file info, including time-stamp
+        oldzi = inf.getinfo(path)
+        # copy across useful fields
+        zi.date_time = oldzi.date_time
+        zi.comment = oldzi.comment
+        zi.extra = oldzi.extra
+        zi.internal_attr = oldzi.internal_attr
+        # external attributes are dependent on the create system, so copy both.
+        zi.external_attr = oldzi.external_attr
+        zi.create_system = oldzi.create_system
+    except:
+        pass
+    setchecksum(zi, check)
+    with spool:
+        writerawmember(outf, zi, readchunks(spool))
+
 def decryptBook(userkey, inpath, outpath):
     if AES is None:
         raise ADEPTError("PyCrypto or OpenSSL must be installed.")
     rsa = RSA(userkey)
-    with closing(ZipFile(open(inpath, 'rb'))) as inf:
+    with closing(TolerantZipFile(open(inpath, 'rb'))) as inf:
         namelist = set(inf.namelist())
         if 'META-INF/rights.xml' not in namelist or \
            'META-INF/encryption.xml' not in namelist:
             print("{0:s} is DRM-free.".format(os.path.basename(inpath)))
             return 1
         for name in META_NAMES:
-            namelist.remove(name)
+            namelist.discard(name)
         try:
             rights = etree.fromstring(inf.read('META-INF/rights.xml'))
             adept = lambda tag: '{%s}%s' % (NSMAP['adept'], tag)
@@ -440,25 +553,22 @@ def decryptBook(userkey, inpath, outpath):
                     zi.create_system = oldzi.create_system
                 except:
                     pass
-                outf.writestr(zi, inf.read('mimetype'))
-                for path in namelist:
-                    data = inf.read(path)
-                    zi = ZipInfo(path)
-                    zi.compress_type=ZIP_DEFLATED
-                    try:
-                        # get the file info, including time-stamp
-                        oldzi = inf.getinfo(path)
-                        # copy across useful fields
-                        zi.date_time = oldzi.date_time
-                        zi.comment = oldzi.comment
-                        zi.extra = oldzi.extra
-                        zi.internal_attr = oldzi.internal_attr
-                        # external attributes are dependent on the create system, so copy both.
-                        zi.external_attr = oldzi.external_attr
-                        zi.create_system = oldzi.create_system
-                    except:
-                        pass
-                    outf.writestr(zi, decryptor.decrypt(path, data))
+                outf.writestr(zi, MIMETYPE)
+                # members are decrypted on a pool of threads, and written
+                # out here in their original order a bounded number behind
+                pending = collections.deque()
+                with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+                    for path in inf.namelist():
+                        if path not in namelist:
+                            continue
+                        if decryptor.isencrypted(path):
+                            pending.append((path, pool.submit(decryptor.decryptmember, inf, path)))
+                        else:
+                            pending.append((path, None))
+                        if len(pending) > 2 * WORKERS:
+                            writemember(inf, outf, *pending.popleft())
+                    while pending:
+                        writemember(inf, outf, *pending.popleft())
         except:
             print("Could not decrypt {0:s} because of an exception:\n{1:s}".format(os.path.basename(inpath), traceback.format_exc()))
             return 2
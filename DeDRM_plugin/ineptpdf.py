@@ -46,13 +46,27 @@
 #   8.0.5 - Do not process DRM-free documents
 #   8.0.6 - Replace use of float by Decimal for greater precision, and import tkFileDialog
 #   9.0.0 - Add Python 3 compatibility for calibre 5
+#   9.0.1 - Report the user UUID a book's rights were issued to
+#   9.0.2 - Buffer the serializer's output and write objects in id order
+#   9.0.3 - Tokenise over a memory map of the whole file
+#   9.0.4 - Bound the object cache and drop objects once they're written
+#   9.0.5 - Decode filters and predictors with pdffilters, adding LZW,
+#           ASCIIHex, TIFF and all PNG predictors
+#   9.0.6 - Decrypt streams on a pool of threads ahead of writing them
+#   9.0.7 - Decrypt RC4 documents in place in a copy of the file
+#   9.0.8 - Pack objects into new compressed object streams when writing
+#           cross reference streams
+#   9.0.9 - Parse the document once and try each of a list of keys on it
+#   9.0.10 - Decode xref streams whole, scan object stream headers directly
+#            and keep both for when the same file is opened again
+#   9.0.11 - Optionally write streams that are repeated exactly just once
 
 """
 Decrypts Adobe ADEPT-encrypted PDF files.
 """
 
 __license__ = 'GPL v3'
-__version__ = "9.0.0"
+__version__ = "9.0.11"
 
 import codecs
 import sys
@@ -61,11 +75,21 @@ import re
 import zlib
 import struct
 import hashlib
+import mmap
 from io import BytesIO
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 import itertools
 import xml.etree.ElementTree as etree
 
+try:
+    from pdffilters import ascii85decode, asciihexdecode, lzwdecode, predict
+    from ziputils import WORKERS, zlibcompress
+except:
+    from calibre_plugins.dedrm.pdffilters import ascii85decode, asciihexdecode, lzwdecode, predict
+    from calibre_plugins.dedrm.ziputils import WORKERS, zlibcompress
+
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
 # encoded using "replace" before writing them.
@@ -415,9 +439,41 @@ ARC4, RSA, AES = _load_crypto()
 
 GEN_XREF_STM = 1
 
+# When we generate cross reference streams, do we pack all the objects
+# that aren't streams into new compressed object streams of up to
+# OBJSTM_SIZE objects each? If not, the input's object streams are
+# copied as they are, and documents without them gain none.
+PACK_OBJ_STM = True
+OBJSTM_SIZE = 200
+
+# Do we write streams that repeat an earlier stream exactly, in dictionary
+# and decrypted data, just once, pointing every reference at that copy?
+# Finding them takes an extra pass reading every object, which on large
+# documents means parsing them twice, so it is off unless asked for.
+# Documents decrypted in place (see REWRITE_IN_PLACE) are never deduped.
+DEDUPE_STREAMS = False
+
+# Do we decrypt RC4 documents (which is all ADEPT ones) by overwriting the
+# encrypted bytes in a copy of the file, rather than writing every object
+# out afresh? Documents it can't handle are written out afresh anyway.
+REWRITE_IN_PLACE = True
+
 # This is the value for the current document
 gen_xref_stm = False # will be set in PDFSerializer
 
+# PDFSerializer collects its output into writes of about this size
+WRITE_BUFFER_SIZE = 1024*1024
+
+# PDFDocument keeps at most this many resolved objects, and the decoded
+# data of this many object streams. Streams themselves are never kept:
+# they are read from the file again if they are needed again.
+OBJ_CACHE_COUNT = 4096
+OBJSTM_CACHE_COUNT = 32
+
+# The indexes (xref stream entries and object stream headers) of this many
+# files are kept, for when the same file is opened again.
+INDEX_CACHE_FILES = 4
+
 # PDF parsing routines from pdfminer, with changes for EBX_HANDLER
 
 #  Utilities
@@ -432,6 +488,63 @@ def choplist(n, seq):
             r = []
     return
 
+# struct codes for the field widths xref streams usually have
+XREF_FIELD_FORMATS = {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}
+
+def xref_fields(data, widths):
+    '''Splits fixed width xref stream entries into a list per field.'''
+    entlen = sum(widths)
+    count = len(data) // entlen
+    data = data[:count * entlen]
+    if not count:
+        return [[] if width else None for width in widths]
+    # each field's bytes are sliced out of all the entries at once into a
+    # column of the next width struct knows, and unpacked in one go
+    fields = []
+    start = 0
+    for width in widths:
+        if not width:
+            fields.append(None)
+            continue
+        size = min(size for size in XREF_FIELD_FORMATS if size >= width)
+        column = bytearray(size * count)
+        for i in range(width):
+            column[size-width+i::size] = data[start+i::entlen]
+        fields.append(list(struct.unpack('>%d%s' % (count, XREF_FIELD_FORMATS[size]), column)))
+        start += width
+    return fields
+
+def objstm_offsets(dic, data):
+    '''Scans the integer pairs at the head of an object stream for the
+    position of each of its objects.'''
+    n = int_value(dic.get('N', 0))
+    first = int_value(dic.get('First', 0))
+    try:
+        fields = [int(field) for field in data[:first].split()[:2*n]]
+    except ValueError:
+        fields = []
+    if len(fields) < 2*n:
+        raise PDFSyntaxError('Invalid object stream header: %r' % dic)
+    return [first + offset for offset in fields[1::2]]
+
+_index_cache = OrderedDict()
+
+def cached_index(fingerprint, pos, load):
+    '''The index read from pos in the file with this fingerprint, taken
+    from the cache if it's there and from load() if not.'''
+    if fingerprint is None or pos is None:
+        return load()
+    try:
+        indexes = _index_cache[fingerprint]
+        _index_cache.move_to_end(fingerprint)
+    except KeyError:
+        indexes = _index_cache[fingerprint] = {}
+        if len(_index_cache) > INDEX_CACHE_FILES:
+            _index_cache.popitem(last=False)
+    if pos not in indexes:
+        indexes[pos] = load()
+    return indexes[pos]
+
 def nunpack(s, default=0):
     '''Unpacks up to 4 bytes big endian.'''
     l = len(s)
@@ -567,58 +680,60 @@ class PSBaseParser(object):
 
     '''
     Most basic PostScript parser that performs only basic tokenization.
+
+    The whole file is memory mapped (or read, if it can't be), so the
+    tokenizer scans a single buffer and positions in it are file offsets.
     '''
-    BUFSIZ = 4096
 
     def __init__(self, fp):
         self.fp = fp
+        self.buf = self.mapfile(fp)
         self.seek(0)
         return
 
     def __repr__(self):
-        return '<PSBaseParser: %r, bufpos=%d>' % (self.fp, self.bufpos)
+        return '<PSBaseParser: %r, charpos=%d>' % (self.fp, self.charpos)
+
+    def mapfile(self, fp):
+        try:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # not a real file (or an empty one)
+            fp.seek(0)
+            return fp.read()
 
     def flush(self):
         return
 
     def close(self):
         self.flush()
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
         return
 
     def tell(self):
-        return self.bufpos+self.charpos
+        return self.charpos
 
     def poll(self, pos=None, n=80):
-        pos0 = self.fp.tell()
-        if not pos:
-            pos = self.bufpos+self.charpos
-        self.fp.seek(pos)
-        self.fp.seek(pos0)
         return
 
     def seek(self, pos):
         '''
         Seeks the parser to the given position.
         '''
-        self.fp.seek(pos)
         # reset the status for nextline()
-        self.bufpos = pos
-        self.buf = b''
-        self.charpos = 0
+        self.charpos = pos
         # reset the status for nexttoken()
         self.parse1 = self.parse_main
-        self.tokens = []
+        self.tokens = deque()
         return
 
     def fillbuf(self):
         if self.charpos < len(self.buf): return
-        # fetch next chunk.
-        self.bufpos = self.fp.tell()
-        self.buf = self.fp.read(self.BUFSIZ)
-        if not self.buf:
-            raise PSEOF('Unexpected EOF')
-        self.charpos = 0
-        return
+        raise PSEOF('Unexpected EOF')
+
+    def read(self, pos, n):
+        return self.buf[pos:pos+n]
 
     def parse_main(self, s, i):
         m = NONSPC.search(s, i)
@@ -626,7 +741,7 @@ class PSBaseParser(object):
             return (self.parse_main, len(s))
         j = m.start(0)
         c = bytes([s[j]])
-        self.tokenstart = self.bufpos+j
+        self.tokenstart = j
         if c == b'%':
             self.token = c
             return (self.parse_comment, j+1)
@@ -803,7 +918,7 @@ class PSBaseParser(object):
         while not self.tokens:
             self.fillbuf()
             (self.parse1, self.charpos) = self.parse1(self.buf, self.charpos)
-        token = self.tokens.pop(0)
+        token = self.tokens.popleft()
         return token
 
     def nextline(self):
@@ -811,7 +926,7 @@ class PSBaseParser(object):
         Fetches a next line that ends either with \\r or \\n.
         '''
         linebuf = b''
-        linepos = self.bufpos + self.charpos
+        linepos = self.charpos
         eol = False
         while 1:
             self.fillbuf()
@@ -840,23 +955,14 @@ class PSBaseParser(object):
         Fetches a next line backword. This is used to locate
         the trailers at the end of a file.
         '''
-        self.fp.seek(0, 2)
-        pos = self.fp.tell()
-        buf = b''
-        while 0 < pos:
-            prevpos = pos
-            pos = max(0, pos-self.BUFSIZ)
-            self.fp.seek(pos)
-            s = self.fp.read(prevpos-pos)
-            if not s: break
-            while 1:
-                n = max(s.rfind(b'\r'), s.rfind(b'\n'))
-                if n == -1:
-                    buf = s + buf
-                    break
-                yield s[n:]+buf
-                s = s[:n]
-                buf = b''
+        buf = self.buf
+        end = len(buf)
+        while 1:
+            n = max(buf.rfind(b'\r', 0, end), buf.rfind(b'\n', 0, end))
+            if n == -1:
+                break
+            yield buf[n:end]
+            end = n
         return
 
 
@@ -873,7 +979,7 @@ class PSStackParser(PSBaseParser):
         self.context = []
         self.curtype = None
         self.curstack = []
-        self.results = []
+        self.results = deque()
         return
 
     def seek(self, pos):
@@ -961,7 +1067,7 @@ class PSStackParser(PSBaseParser):
                 if direct:
                     return self.pop(1)[0]
                 self.flush()
-        obj = self.results.pop(0)
+        obj = self.results.popleft()
         return obj
 
 
@@ -969,6 +1075,7 @@ LITERAL_CRYPT = LIT(b'Crypt')
 LITERALS_FLATE_DECODE = (LIT(b'FlateDecode'), LIT(b'Fl'))
 LITERALS_LZW_DECODE = (LIT(b'LZWDecode'), LIT(b'LZW'))
 LITERALS_ASCII85_DECODE = (LIT(b'ASCII85Decode'), LIT(b'A85'))
+LITERALS_ASCIIHEX_DECODE = (LIT(b'ASCIIHexDecode'), LIT(b'AHx'))
 
 
 ##  PDF Objects
@@ -1097,29 +1204,6 @@ def stream_value(x):
         return PDFStream({}, '')
     return x
 
-# ascii85decode(data)
-def ascii85decode(data):
-    n = b = 0
-    out = b''
-    for c in data:
-        if b'!' <= c and c <= b'u':
-            n += 1
-            b = b*85+(c-33)
-            if n == 5:
-                out += struct.pack('>L',b)
-                n = b = 0
-        elif c == b'z':
-            assert n == 0
-            out += b'\0\0\0\0'
-        elif c == b'~':
-            if n:
-                for _ in range(5-n):
-                    b = b*85+84
-                out += struct.pack('>L',b)[:n-1]
-            break
-    return out
-
-
 ##  PDFStream type
 class PDFStream(PDFObject):
     def __init__(self, dic, rawdata, decipher=None):
@@ -1142,6 +1226,8 @@ class PDFStream(PDFObject):
         self.decdata = None
         self.objid = None
         self.genno = None
+        # where the data starts in the file, if it came from one
+        self.datapos = None
         return
 
     def set_objid(self, objid, genno):
@@ -1172,44 +1258,41 @@ class PDFStream(PDFObject):
         filters = self.dic['Filter']
         if not isinstance(filters, list):
             filters = [ filters ]
-        for f in filters:
+        if 'DP' in self.dic:
+            params = self.dic['DP']
+        else:
+            params = self.dic.get('DecodeParms', {})
+        # parameters are given per filter, or once for all of them
+        if not isinstance(params, list):
+            params = [ params ] * len(filters)
+        for (f, params) in zip(filters, params):
+            params = resolve1(params)
+            if not isinstance(params, dict):
+                params = {}
             if f in LITERALS_FLATE_DECODE:
                 # will get errors if the document is encrypted.
                 data = zlib.decompress(data)
             elif f in LITERALS_LZW_DECODE:
-                data = b''.join(LZWDecoder(BytesIO(data)).run())
+                data = lzwdecode(data, int_value(params.get('EarlyChange', 1)))
             elif f in LITERALS_ASCII85_DECODE:
                 data = ascii85decode(data)
+            elif f in LITERALS_ASCIIHEX_DECODE:
+                data = asciihexdecode(data)
             elif f == LITERAL_CRYPT:
                 raise PDFNotImplementedError('/Crypt filter is unsupported')
             else:
                 raise PDFNotImplementedError('Unsupported filter: %r' % f)
             # apply predictors
-            if 'DP' in self.dic:
-                params = self.dic['DP']
-            else:
-                params = self.dic.get('DecodeParms', {})
-            if 'Predictor' in params:
-                pred = int_value(params['Predictor'])
-                if pred:
-                    if pred != 12:
-                        raise PDFNotImplementedError(
-                            'Unsupported predictor: %r' % pred)
-                    if 'Columns' not in params:
-                        raise PDFValueError(
-                            'Columns undefined for predictor=12')
-                    columns = int_value(params['Columns'])
-                    buf = b''
-                    ent0 = b'\x00' * columns
-                    for i in range(0, len(data), columns+1):
-                        pred = data[i]
-                        ent1 = data[i+1:i+1+columns]
-                        if pred == b'\x02':
-                            ent1 = b''.join(bytes([(a+b) & 255]) \
-                                           for (a,b) in zip(ent0,ent1))
-                        buf += ent1
-                        ent0 = ent1
-                    data = buf
+            if f in LITERALS_FLATE_DECODE or f in LITERALS_LZW_DECODE:
+                pred = int_value(params.get('Predictor', 1))
+                if pred > 1:
+                    try:
+                        data = predict(data, pred,
+                                       int_value(params.get('Colors', 1)),
+                                       int_value(params.get('BitsPerComponent', 8)),
+                                       int_value(params.get('Columns', 1)))
+                    except ValueError as e:
+                        raise PDFNotImplementedError(str(e))
         self.data = data
         self.rawdata = None
         return
@@ -1256,6 +1339,8 @@ class PDFXRef(object):
 
     def __init__(self):
         self.offsets = None
+        # set when rebuilt by scanning a file whose xref is broken
+        self.recovered = False
         return
 
     def __repr__(self):
@@ -1326,8 +1411,7 @@ class PDFXRefStream(object):
 
     def __init__(self):
         self.index = None
-        self.data = None
-        self.entlen = None
+        self.offsets = None
         self.fl1 = self.fl2 = self.fl3 = None
         return
 
@@ -1335,9 +1419,7 @@ class PDFXRefStream(object):
         return '<PDFXRef: objids=%s>' % self.index
 
     def objids(self):
-        for first, size in self.index:
-            for objid in range(first, first + size):
-                yield objid
+        return iter(self.offsets)
 
     def load(self, parser, debug=0):
         (_,objid) = parser.nexttoken() # ignored
@@ -1349,35 +1431,36 @@ class PDFXRefStream(object):
             raise PDFNoValidXRef('Invalid PDF stream spec.')
         size = stream.dic['Size']
         index = stream.dic.get('Index', (0,size))
-        self.index = zip(itertools.islice(index, 0, None, 2),
-                         itertools.islice(index, 1, None, 2))
+        self.index = list(zip(itertools.islice(index, 0, None, 2),
+                              itertools.islice(index, 1, None, 2)))
         (self.fl1, self.fl2, self.fl3) = stream.dic['W']
-        self.data = stream.get_data()
-        self.entlen = self.fl1+self.fl2+self.fl3
+        if not (self.fl1 + self.fl2 + self.fl3) or max(self.fl1, self.fl2, self.fl3) > 8:
+            raise PDFNoValidXRef('Invalid xref entry widths: %r' % stream.dic['W'])
+        self.offsets = cached_index(parser.fingerprint, stream.datapos,
+                                    lambda: self.load_entries(stream.get_data()))
         self.trailer = stream.dic
         return
 
+    # All the entries are decoded at once, into (stmid, index) for objects
+    # in object streams and (None, pos) for the others. Free ones are left
+    # out. Missing fields have their default values.
+    def load_entries(self, data):
+        (types, fields2, fields3) = xref_fields(data, (self.fl1, self.fl2, self.fl3))
+        objids = itertools.chain.from_iterable(range(first, first + size)
+                                               for (first, size) in self.index)
+        offsets = {}
+        for (objid, f1, f2, f3) in zip(objids,
+                                       types or itertools.repeat(1),
+                                       fields2 or itertools.repeat(0),
+                                       fields3 or itertools.repeat(0)):
+            if f1 == 1:
+                offsets[objid] = (None, f2)
+            elif f1 == 2:
+                offsets[objid] = (f2, f3)
+        return offsets
+
     def getpos(self, objid):
-        offset = 0
-        for first, size in self.index:
-            if first <= objid  and objid < (first + size):
-                break
-            offset += size
-        else:
-            raise KeyError(objid)
-        i = self.entlen * ((objid - first) + offset)
-        ent = self.data[i:i+self.entlen]
-        f1 = nunpack(ent[:self.fl1], 1)
-        if f1 == 1:
-            pos = nunpack(ent[self.fl1:self.fl1+self.fl2])
-            genno = nunpack(ent[self.fl1+self.fl2:])
-            return (None, pos)
-        elif f1 == 2:
-            objid = nunpack(ent[self.fl1:self.fl1+self.fl2])
-            index = nunpack(ent[self.fl1+self.fl2:])
-            return (objid, index)
-        # this is a free object
-        raise KeyError(objid)
+        return self.offsets[objid]
 
 
 ##  PDFDocument
@@ -1391,8 +1474,8 @@ class PDFDocument(object):
 
     def __init__(self):
         self.xrefs = []
-        self.objs = {}
-        self.parsed_objs = {}
+        self.objs = OrderedDict()
+        self.parsed_objs = OrderedDict()
         self.root = None
         self.catalog = None
         self.parser = None
@@ -1591,12 +1674,13 @@ class PDFDocument(object):
         self.is_printable = self.is_modifiable = self.is_extractable = True
         rsa = RSA(password)
         length = int_value(param.get('Length', 0)) // 8
-        rights = codecs.decode(param.get('ADEPT_LICENSE'), 'base64')
-        rights = zlib.decompress(rights, -15)
-        rights = etree.fromstring(rights)
+        rights = ebx_rights(param)
         expr = './/{http://ns.adobe.com/adept}encryptedKey'
         bookkey = codecs.decode(''.join(rights.findtext(expr)).encode('utf-8'),'base64')
         bookkey = rsa.decrypt(bookkey)
+        if not isinstance(bookkey, bytes):
+            # PKCS#1 padding was wrong, so this isn't the book's user key
+            raise ADEPTError('error decrypting book session key')
         #if bookkey[0] != 2:
         #    raise ADEPTError('error decrypting book session key')
         if len(bookkey) > 16:
@@ -1696,6 +1780,7 @@ class PDFDocument(object):
         if objid in self.objs:
             genno = 0
             obj = self.objs[objid]
+            self.objs.move_to_end(objid)
         else:
             for xref in self.xrefs:
                 try:
@@ -1711,34 +1796,29 @@ class PDFDocument(object):
                 if gen_xref_stm:
                     return PDFObjStmRef(objid, stmid, index)
                 # Stuff from pdfminer: extract objects from object stream
-                stream = stream_value(self.getobj(stmid))
-                if stream.dic.get('Type') is not LITERAL_OBJSTM:
-                    if STRICT:
-                        raise PDFSyntaxError('Not a stream object: %r' % stream)
-                try:
-                    n = stream.dic['N']
-                except KeyError:
-                    if STRICT:
-                        raise PDFSyntaxError('N is not defined: %r' % stream)
-                    n = 0
-
                 if stmid in self.parsed_objs:
-                    objs = self.parsed_objs[stmid]
+                    (offsets, parser) = self.parsed_objs[stmid]
+                    self.parsed_objs.move_to_end(stmid)
                 else:
-                    parser = PDFObjStrmParser(stream.get_data(), self)
-                    objs = []
-                    try:
-                        while 1:
-                            (_,obj) = parser.nextobject()
-                            objs.append(obj)
-                    except PSEOF:
-                        pass
-                    self.parsed_objs[stmid] = objs
+                    stream = stream_value(self.getobj(stmid))
+                    if stream.dic.get('Type') is not LITERAL_OBJSTM:
+                        if STRICT:
+                            raise PDFSyntaxError('Not a stream object: %r' % stream)
+                    if 'N' not in stream.dic:
+                        if STRICT:
+                            raise PDFSyntaxError('N is not defined: %r' % stream)
+                    data = stream.get_data()
+                    offsets = cached_index(self.parser.fingerprint, stream.datapos,
+                                           lambda: objstm_offsets(stream.dic, data))
+                    parser = PDFObjStrmParser(data, self)
+                    self.parsed_objs[stmid] = (offsets, parser)
+                    if len(self.parsed_objs) > OBJSTM_CACHE_COUNT:
+                        self.parsed_objs.popitem(last=False)
                 genno = 0
-                i = n*2+index
                 try:
-                    obj = objs[i]
-                except IndexError:
+                    parser.seek(offsets[index])
+                    (_,obj) = parser.nextobject()
+                except (IndexError, PSEOF):
                     raise PDFSyntaxError('Invalid object number: objid=%r' % (objid))
                 if isinstance(obj, PDFStream):
                     obj.set_objid(objid, 0)
@@ -1765,11 +1845,24 @@ class PDFDocument(object):
                 (_,obj) = self.parser.nextobject()
                 if isinstance(obj, PDFStream):
                     obj.set_objid(objid, genno)
-                if self.decipher:
+                    # strings in a stream's dictionary are encrypted too,
+                    # except in an xref stream's
+                    if self.decipher and obj.dic.get('Type') is not LITERAL_XREF:
+                        obj.dic = decipher_all(self.decipher, objid, genno, obj.dic)
+                elif self.decipher:
                     obj = decipher_all(self.decipher, objid, genno, obj)
-            self.objs[objid] = obj
+            if not isinstance(obj, PDFStream):
+                self.objs[objid] = obj
+                if len(self.objs) > OBJ_CACHE_COUNT:
+                    self.objs.popitem(last=False)
         return obj
 
+    # evict(objid)
+    #   Forget an object that won't be asked for again, e.g. once written out.
+    def evict(self, objid):
+        self.objs.pop(objid, None)
+        return
+
 
 class PDFObjStmRef(object):
     maxindex = 0
@@ -1787,6 +1880,14 @@ class PDFParser(PSStackParser):
 
     def __init__(self, doc, fp):
         PSStackParser.__init__(self, fp)
+        # the file, for the index cache: its size, modification time and
+        # the tail, where the trailer is
+        try:
+            st = os.fstat(fp.fileno())
+            self.fingerprint = (st.st_size, st.st_mtime_ns,
+                                hashlib.md5(self.buf[-1024:]).digest())
+        except (AttributeError, OSError, ValueError):
+            self.fingerprint = None
         self.doc = doc
         self.doc.set_parser(self)
         return
@@ -1836,8 +1937,7 @@ class PDFParser(PSStackParser):
                     raise PDFSyntaxError('Unexpected EOF')
                 return
             pos += len(line)
-            self.fp.seek(pos)
-            data = self.fp.read(objlen)
+            data = self.read(pos, objlen)
             self.seek(pos+objlen)
             while 1:
                 try:
@@ -1855,6 +1955,7 @@ class PDFParser(PSStackParser):
                 data += line
             self.seek(pos+objlen)
             obj = PDFStream(dic, data, self.doc.decipher)
+            obj.datapos = pos
             self.push((pos, obj))
             return
 
@@ -1922,6 +2023,7 @@ class PDFParser(PSStackParser):
             pat = re.compile(rb'^(\d+)\s+(\d+)\s+obj\b')
             offsets = {}
             xref = PDFXRef()
+            xref.recovered = True
             while 1:
                 try:
                     (pos, line) = self.nextline()
@@ -1974,14 +2076,15 @@ class PDFObjStrmParser(PDFParser):
 ### My own code, for which there is none else to blame
 
 class PDFSerializer(object):
-    def __init__(self, inf, userkey):
+    def __init__(self, inf, userkey=None):
         global GEN_XREF_STM, gen_xref_stm
         gen_xref_stm = GEN_XREF_STM > 1
         self.version = inf.read(8)
         inf.seek(0)
         self.doc = doc = PDFDocument()
         parser = PDFParser(doc, inf)
-        doc.initialize(userkey)
+        if userkey is not None:
+            doc.initialize(userkey)
         self.objids = objids = set()
         for xref in reversed(doc.xrefs):
             trailer = xref.trailer
@@ -1993,10 +2096,48 @@ class PDFSerializer(object):
         if 'Encrypt' in trailer:
             objids.remove(trailer.pop('Encrypt').objid)
         self.trailer = trailer
+        # packing repacks every object, so the input's object streams
+        # are unpacked rather than copied
+        self.pack = gen_xref_stm and PACK_OBJ_STM
+        if self.pack:
+            gen_xref_stm = False
+        # objid -> the earlier objid of the same stream
+        self.duplicates = {}
+
+    def initialize(self, userkey):
+        # check userkey against the document's Encrypt dictionary, and
+        # if it opens the document set it up to decrypt with that key.
+        # anything read with an earlier key is deciphered wrongly
+        self.doc.objs.clear()
+        self.doc.parsed_objs.clear()
+        self.duplicates = {}
+        try:
+            self.doc.initialize(userkey)
+        except PDFEncryptionError:
+            raise
+        except Exception as e:
+            print("Key does not open the document: {0}".format(e))
+            return False
+        return True
+
+    def close(self):
+        # release the parser's map of the input file
+        self.doc.parser.close()
+
+    def useruuid(self):
+        # the user UUID the book was fulfilled for, from the parse already done
+        return ebx_user(self.doc)
 
     def dump(self, outf):
         self.outf = outf
-        self.write(self.version)
+        self.buffer = []
+        self.buffered = 0
+        self.pos = outf.tell()
+        version = self.version
+        if (gen_xref_stm or self.pack) and version[5:] < b'1.5':
+            # xref streams and object streams need PDF 1.5
+            version = b'%PDF-1.5'
+        self.write(version)
         self.write(b'\n%\xe2\xe3\xcf\xd3\n')
         doc = self.doc
         objids = self.objids
@@ -2004,29 +2145,50 @@ class PDFSerializer(object):
         maxobj = max(objids)
         trailer = dict(self.trailer)
         trailer['Size'] = maxobj + 1
-        for objid in objids:
-            obj = doc.getobj(objid)
-            if isinstance(obj, PDFObjStmRef):
-                xrefs[objid] = obj
-                continue
-            if obj is not None:
-                try:
-                    genno = obj.genno
-                except AttributeError:
-                    genno = 0
-                xrefs[objid] = (self.tell(), genno)
-                self.serialize_indirect(objid, obj)
+        if DEDUPE_STREAMS:
+            self.find_duplicates()
+        # new object streams take the ids after the document's own
+        self.packed = []
+        self.nextobj = maxobj + 1
+        # ascending ids keep the output, and its xref, in file order.
+        # Streams are decrypted, and packed objects compressed, on a pool
+        # of threads while the objects after them are parsed, and written
+        # out a bounded number behind.
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            for objid in sorted(objids):
+                if objid in self.duplicates:
+                    continue
+                obj = doc.getobj(objid)
+                if self.pack and not isinstance(obj, PDFStream):
+                    if obj is not None:
+                        self.pack_object(xrefs, objid, obj)
+                    if len(self.packed) >= OBJSTM_SIZE:
+                        pending.append(self.pack_objstm(pool))
+                elif self.pack and obj.dic.get('Type') in (LITERAL_OBJSTM, LITERAL_XREF):
+                    # superseded by the new object streams and xref stream
+                    pass
+                elif isinstance(obj, PDFStream) and obj.decipher:
+                    pending.append((objid, obj, pool.submit(obj.get_decdata)))
+                else:
+                    pending.append((objid, obj, None))
+                if len(pending) > 2 * WORKERS:
+                    self.dump_object(xrefs, *pending.popleft())
+            if self.packed:
+                pending.append(self.pack_objstm(pool))
+            while pending:
+                self.dump_object(xrefs, *pending.popleft())
+        maxobj = self.nextobj - 1
         startxref = self.tell()
 
-        if not gen_xref_stm:
+        if not (gen_xref_stm or self.pack):
             self.write(b'xref\n')
             self.write(b'0 %d\n' % (maxobj + 1,))
-            for objid in range(0, maxobj + 1):
-                if objid in xrefs:
-                    # force the genno to be 0
-                    self.write(b"%010d 00000 n \n" % xrefs[objid][0])
-                else:
-                    self.write(b"%010d %05d f \n" % (0, 65535))
+            free = b"%010d %05d f \n" % (0, 65535)
+            # force the genno to be 0
+            self.write(b''.join(b"%010d 00000 n \n" % xrefs[objid][0]
+                                if objid in xrefs else free
+                                for objid in range(0, maxobj + 1)))
 
             self.write(b'trailer\n')
             self.serialize_object(trailer)
@@ -2079,7 +2241,7 @@ class PDFSerializer(object):
                 data.append(struct.pack('>L', f2)[-fl2:])
                 data.append(struct.pack('>L', f3)[-fl3:])
             index.extend((first, prev - first + 1))
-            data = zlib.compress(b''.join(data))
+            data = zlibcompress(b''.join(data))
             dic = {'Type': LITERAL_XREF, 'Size': prev + 1, 'Index': index,
                    'W': [1, fl2, fl3], 'Length': len(data),
                    'Filter': LITERALS_FLATE_DECODE[0],
@@ -2089,12 +2251,125 @@ class PDFSerializer(object):
             xrefstm = PDFStream(dic, data)
             self.serialize_indirect(maxobj, xrefstm)
             self.write(b'startxref\n%d\n%%%%EOF' % startxref)
+        self.flush()
+
+    def dump_object(self, xrefs, objid, obj, decrypted):
+        if isinstance(obj, PDFObjStmRef):
+            xrefs[objid] = obj
+            return
+        if obj is None:
+            return
+        if decrypted is not None:
+            obj.decdata = decrypted.result()
+        try:
+            genno = obj.genno
+        except AttributeError:
+            genno = 0
+        xrefs[objid] = (self.tell(), genno)
+        self.serialize_indirect(objid, obj)
+        self.doc.evict(objid)
+
+    def find_duplicates(self):
+        # Streams can only be the same if their dictionaries (bar Length)
+        # and encrypted lengths are, so only those that share both with
+        # another stream are decrypted and hashed, on a pool of threads.
+        doc = self.doc
+        candidates = {}
+        for objid in sorted(self.objids):
+            obj = doc.getobj(objid)
+            if not isinstance(obj, PDFStream) or \
+                   obj.dic.get('Type') in (LITERAL_OBJSTM, LITERAL_XREF):
+                continue
+            dic = dict(obj.dic)
+            dic.pop('Length', None)
+            key = (len(obj.rawdata), self.tobytes(dic))
+            candidates.setdefault(key, []).append(objid)
+        def digest(obj):
+            return hashlib.sha256(obj.get_decdata()).digest()
+        # The parser isn't thread safe, so the streams are read here and
+        # only decrypted and hashed on the pool, a bounded number ahead.
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            for objids in candidates.values():
+                if len(objids) < 2:
+                    continue
+                first = {}
+                pending = deque()
+                for objid in objids:
+                    pending.append((objid, pool.submit(digest, doc.getobj(objid))))
+                    if len(pending) > 2 * WORKERS:
+                        self.add_duplicate(first, *pending.popleft())
+                while pending:
+                    self.add_duplicate(first, *pending.popleft())
+
+    def add_duplicate(self, first, objid, digest):
+        # first maps each digest seen to the first stream with it
+        sha = digest.result()
+        if sha in first:
+            self.duplicates[objid] = first[sha]
+        else:
+            first[sha] = objid
+
+    def tobytes(self, obj):
+        # serialize obj on its own, rather than into the output
+        saved = (self.outf, self.buffer, self.buffered, self.pos, self.last)
+        self.outf = BytesIO()
+        self.buffer = []
+        self.buffered = 0
+        self.pos = 0
+        self.last = b'\n'
+        try:
+            self.serialize_object(obj)
+            self.flush()
+            return self.outf.getvalue()
+        finally:
+            (self.outf, self.buffer, self.buffered, self.pos, self.last) = saved
+
+    def pack_object(self, xrefs, objid, obj):
+        # serialize obj on its own, to go in the next object stream
+        xrefs[objid] = PDFObjStmRef(objid, self.nextobj, len(self.packed))
+        self.packed.append((objid, self.tobytes(obj)))
+        self.doc.evict(objid)
+
+    def pack_objstm(self, pool):
+        # an object stream of the objects packed so far, as an entry for
+        # dump_object, with its data compressed on the pool
+        header = []
+        offset = 0
+        for (objid, data) in self.packed:
+            header.append(b'%d %d' % (objid, offset))
+            offset += len(data) + 1
+        header = b' '.join(header) + b'\n'
+        data = header + b'\n'.join(data for (objid, data) in self.packed)
+        dic = {'Type': LITERAL_OBJSTM, 'N': len(self.packed),
+               'First': len(header), 'Filter': LITERALS_FLATE_DECODE[0]}
+        stmid = self.nextobj
+        self.nextobj += 1
+        self.packed = []
+        return (stmid, PDFStream(dic, b''), pool.submit(zlibcompress, data))
+
+    # Tokens are collected in a list and written out a megabyte at a time;
+    # large stream data goes straight to the file rather than being copied.
     def write(self, data):
-        self.outf.write(data)
+        size = len(data)
+        self.pos += size
         self.last = data[-1:]
+        if size >= WRITE_BUFFER_SIZE:
+            self.flush()
+            self.outf.write(data)
+            return
+        self.buffer.append(data)
+        self.buffered += size
+        if self.buffered >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.outf.write(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
 
     def tell(self):
-        return self.outf.tell()
+        return self.pos
 
     def escape_string(self, string):
         string = string.replace(b'\\', b'\\\\')
@@ -2142,16 +2417,19 @@ class PDFSerializer(object):
         elif isinstance(obj, PDFObjRef):
             if self.last.isalnum():
                 self.write(b' ')
-            self.write(b'%d %d R' % (obj.objid, 0))
+            self.write(b'%d %d R' % (self.duplicates.get(obj.objid, obj.objid), 0))
         elif isinstance(obj, PDFStream):
             ### If we don't generate cross ref streams the object streams
             ### are no longer useful, as we have extracted all objects from
             ### them. Therefore leave them out from the output.
-            if obj.dic.get('Type') == LITERAL_OBJSTM and not gen_xref_stm:
-                self.write('(deleted)')
+            if obj.dic.get('Type') == LITERAL_OBJSTM and not (gen_xref_stm or self.pack):
+                self.write(b'(deleted)')
             else:
                 data = obj.get_decdata()
-                self.serialize_object(obj.dic)
+                # AES streams shrink when decrypted, so give the new length
+                dic = dict(obj.dic)
+                dic['Length'] = len(data)
+                self.serialize_object(dic)
                 self.write(b'stream\n')
                 self.write(data)
                 self.write(b'\nendstream')
@@ -2171,19 +2449,193 @@ class PDFSerializer(object):
 
 
 
+###
+### Decryption in place
+
+def has_strings(x):
+    if isinstance(x, bytes) or isinstance(x, bytearray):
+        return True
+    if isinstance(x, PDFStream):
+        return has_strings(x.dic)
+    if isinstance(x, list):
+        return any(has_strings(v) for v in x)
+    if isinstance(x, dict):
+        return any(has_strings(v) for v in x.values())
+    return False
+
+class PDFRewriter(PDFSerializer):
+    '''
+    Writes a copy of the file with each stream's data overwritten by its
+    plaintext. RC4 leaves the data the same length, so every offset in the
+    file still holds. Objects with encrypted strings, which can't keep
+    their length once decrypted and escaped, are appended instead as an
+    incremental update, whose trailer no longer refers to the encryption.
+    That includes streams with strings in their dictionaries.
+    '''
+
+    def rewritable(self):
+        doc = self.doc
+        if doc.decipher != doc.decrypt_rc4:
+            return False
+        # the update's xref table must follow plain xref tables, and as
+        # references are written with generation 0, all objects must be
+        for xref in doc.xrefs:
+            if not isinstance(xref, PDFXRef) or xref.recovered:
+                return False
+            if any(genno != 0 for (genno, pos) in xref.offsets.values()):
+                return False
+        return True
+
+    def dump(self, outf):
+        if not self.rewritable():
+            return PDFSerializer.dump(self, outf)
+        self.outf = outf
+        self.buffer = []
+        self.buffered = 0
+        self.pos = outf.tell()
+        doc = self.doc
+        buf = doc.parser.buf
+        offsets = {}
+        for xref in reversed(doc.xrefs):
+            for objid in xref.objids():
+                offsets[objid] = xref.getpos(objid)[1]
+        appended = []
+        self.copied = 0
+        # the streams are decrypted on a pool of threads, and patched
+        # into the copy in file order a bounded number behind
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            for objid in sorted(self.objids, key=lambda objid: offsets[objid]):
+                obj = doc.getobj(objid)
+                if has_strings(obj):
+                    appended.append(objid)
+                elif isinstance(obj, PDFStream):
+                    pending.append((obj.datapos, pool.submit(obj.get_decdata)))
+                    if len(pending) > 2 * WORKERS:
+                        self.patch(buf, *pending.popleft())
+            while pending:
+                self.patch(buf, *pending.popleft())
+        self.copy(buf, len(buf))
+
+        # the incremental update
+        if self.last not in (b'\r', b'\n'):
+            self.write(b'\n')
+        xrefs = {}
+        for objid in appended:
+            xrefs[objid] = self.tell()
+            self.serialize_indirect(objid, doc.getobj(objid))
+        startxref = self.tell()
+        self.write(b'xref\n')
+        sections = []
+        for objid in sorted(xrefs):
+            if sections and sections[-1][-1] == objid - 1:
+                sections[-1].append(objid)
+            else:
+                sections.append([objid])
+        if not sections:
+            # nothing was appended, but the section needs a subsection,
+            # so it gives the head of the free list again
+            self.write(b'0 1\n%010d %05d f \n' % (0, 65535))
+        for section in sections:
+            self.write(b'%d %d\n' % (section[0], len(section)))
+            self.write(b''.join(b"%010d 00000 n \n" % xrefs[objid]
+                                for objid in section))
+        trailer = dict(doc.xrefs[0].trailer)
+        trailer.pop('Encrypt', None)
+        trailer['Prev'] = doc.parser.find_xref()
+        trailer['Size'] = max(int_value(trailer.get('Size', 0)), max(self.objids) + 1)
+        self.write(b'trailer\n')
+        self.serialize_object(trailer)
+        self.write(b'\nstartxref\n%d\n%%%%EOF\n' % startxref)
+        self.flush()
+
+    def copy(self, buf, end):
+        # copy the file up to end, straight from the parser's map
+        if end > self.copied:
+            self.flush()
+            with memoryview(buf) as view:
+                self.outf.write(view[self.copied:end])
+            self.pos += end - self.copied
+            self.last = buf[end-1:end]
+            self.copied = end
+
+    def patch(self, buf, datapos, decrypted):
+        data = decrypted.result()
+        self.copy(buf, datapos)
+        self.write(data)
+        self.copied = datapos + len(data)
+
+
+def ebx_rights(param):
+    rights = codecs.decode(param.get('ADEPT_LICENSE'), 'base64')
+    rights = zlib.decompress(rights, -15)
+    return etree.fromstring(rights)
+
+# the user UUID (urn:uuid:...) a parsed book was fulfilled for, if the rights say
+def ebx_user(doc):
+    try:
+        if not doc.encryption:
+            return None
+        (docid, param) = doc.encryption
+        if literal_name(param['Filter']) != 'EBX_HANDLER':
+            return None
+        uuid = ebx_rights(param).findtext('.//{http://ns.adobe.com/adept}user')
+        if uuid:
+            return uuid.strip()
+    except:
+        pass
+    return None
+
+def adeptUserUUID(inpath):
+    try:
+        with open(inpath, 'rb') as inf:
+            doc = PDFDocument()
+            PDFParser(doc, inf).close()
+            return ebx_user(doc)
+    except:
+        return None
+
+
 def decryptBook(userkey, inpath, outpath):
+    return decryptBookWithKeys([userkey], inpath, outpath)[0]
+
+
+def decryptBookWithKeys(userkeys, inpath, outpath):
+    '''
+    Decrypt inpath into outpath with the first of userkeys that opens it.
+    userkeys is a list of keys, or a function that is given the UUID of
+    the user the book was fulfilled for (None if it doesn't say) and
+    returns the keys to try. The document is parsed just once, each key
+    is checked against its Encrypt dictionary in turn, and nothing is
+    written until one fits. If writing fails, the keys after it are tried.
+    Returns the result and the key used, which is None if none fitted.
+    '''
     if RSA is None:
         raise ADEPTError("PyCryptodome or OpenSSL must be installed.")
     with open(inpath, 'rb') as inf:
-        serializer = PDFSerializer(inf, userkey)
-        with open(outpath, 'wb') as outf:
-            # help construct to make sure the method runs to the end
-            try:
-                serializer.dump(outf)
-            except Exception as e:
-                print("error writing pdf: {0}".format(e))
-                return 2
-    return 0
+        if REWRITE_IN_PLACE:
+            serializer = PDFRewriter(inf)
+        else:
+            serializer = PDFSerializer(inf)
+        try:
+            if callable(userkeys):
+                userkeys = userkeys(serializer.useruuid())
+            result, used = 1, None
+            for userkey in userkeys:
+                if not serializer.initialize(userkey):
+                    continue
+                with open(outpath, 'wb') as outf:
+                    # help construct to make sure the method runs to the end
+                    try:
+                        serializer.dump(outf)
+                    except Exception as e:
+                        print("error writing pdf: {0}".format(e))
+                        result, used = 2, userkey
+                        continue
+                return 0, userkey
+            return result, used
+        finally:
+            serializer.close()
 
 
 def cli_main():
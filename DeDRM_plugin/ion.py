@@ -5,7 +5,7 @@
 # Copyright © 2013-2020 Apprentice Harper et al.
 
 __license__ = 'GPL v3'
-__version__ = '3.0'
+__version__ = '3.2'
 
 # Revision history:
 #  Pascal implementation by lulzkabulz.
@@ -16,12 +16,15 @@ __version__ = '3.0'
 #  1.3   - Fixed lzma support for calibre 4.6+
 #  2.0   - VoucherEnvelope v2/v3 support by apprenticesakuya.
 #  3.0   - Added Python 3 compatibility for calibre 5.0
+#  3.1   - Decrypt and decompress DRMION pages on a thread pool
+#  3.2   - Parse the voucher envelope once and check candidate secrets cheaply
 
 """
 Decrypt Kindle KFX files.
 """
 
 import collections
+import concurrent.futures
 import hashlib
 import hmac
 import os
@@ -171,6 +174,13 @@ class ParserState:
 
 ContainerRec = collections.namedtuple("ContainerRec", "nextpos, tid, remaining")
 
+PageRec = collections.namedtuple("PageRec", "data, iv, decompress, decrypt")
+
+
+# pages are independent once the content key is known, and both AES and lzma
+# release the GIL, so they are decoded on a pool of this many threads
+PAGE_WORKERS = os.cpu_count() or 1
+
 
 class BinaryIonParser(object):
     eof = False
@@ -846,6 +856,14 @@ class DrmIonVoucher(object):
     secretkey = b""
 
     def __init__(self, voucherenv, dsn, secret):
+        self.setsecret(dsn, secret)
+
+        self.lockparams = []
+
+        self.envelope = BinaryIonParser(voucherenv)
+        addprottable(self.envelope)
+
+    def setsecret(self, dsn, secret):
         self.dsn, self.secret = dsn, secret
 
         if isinstance(dsn, str):
@@ -854,15 +872,9 @@ class DrmIonVoucher(object):
         if isinstance(secret, str):
             self.secret = secret.encode('ASCII')
 
-        self.lockparams = []
-
-        self.envelope = BinaryIonParser(voucherenv)
-        addprottable(self.envelope)
-
-    def decryptvoucher(self):
+    def getkey(self):
         shared = ("PIDv3" + self.encalgorithm + self.enctransformation + self.hashalgorithm).encode('ASCII')
 
-        self.lockparams.sort()
         for param in self.lockparams:
             if param == "ACCOUNT_SECRET":
                 shared += param.encode('ASCII') + self.secret
@@ -873,7 +885,27 @@ class DrmIonVoucher(object):
 
         sharedsecret = obfuscate(shared, self.version)
 
-        key = hmac.new(sharedsecret, b"PIDv3", digestmod=hashlib.sha256).digest()
+        return hmac.new(sharedsecret, b"PIDv3", digestmod=hashlib.sha256).digest()
+
+    # check the current DSN and secret by decrypting only the final block
+    # and looking at its padding, without raising on a wrong key
+    def checkkey(self):
+        if len(self.ciphertext) < 16 or len(self.ciphertext) % 16 != 0:
+            return False
+
+        if len(self.ciphertext) > 16:
+            iv = self.ciphertext[-32:-16]
+        else:
+            iv = self.cipheriv[:16]
+
+        key = self.getkey()
+        b = AES.new(key[:32], AES.MODE_CBC, iv).decrypt(self.ciphertext[-16:])
+
+        paddinglen = b[-1]
+        return paddinglen > 0 and paddinglen <= 16 and b[-paddinglen:] == bchr(paddinglen) * paddinglen
+
+    def decryptvoucher(self):
+        key = self.getkey()
         aes = AES.new(key[:32], AES.MODE_CBC, self.cipheriv[:16])
         b = aes.decrypt(self.ciphertext)
         b = pkcs7unpad(b, 16)
@@ -944,6 +976,7 @@ class DrmIonVoucher(object):
 
             self.envelope.stepout()
 
+        self.lockparams.sort()
         self.parsevoucher()
 
     def parsevoucher(self):
@@ -1003,6 +1036,17 @@ class DrmIon(object):
         self.onvoucherrequired = onvoucherrequired
 
     def parse(self, outpages):
+        # decode a bounded window of pages ahead, writing them out in order
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+            for page in self.pages():
+                pending.append(pool.submit(self.decodepage, page))
+                if len(pending) > 2 * PAGE_WORKERS:
+                    outpages.write(pending.popleft().result())
+            while pending:
+                outpages.write(pending.popleft().result())
+
+    def pages(self):
         self.ion.reset()
 
         _assert(self.ion.hasnext(), "DRMION envelope is empty")
@@ -1052,7 +1096,7 @@ class DrmIon(object):
                             civ = self.ion.lobvalue()
 
                     if ct is not None and civ is not None:
-                        self.processpage(ct, civ, outpages, decompress, decrypt)
+                        yield PageRec(ct, civ, decompress, decrypt)
                     self.ion.stepout()
 
                 elif self.ion.gettypename() in ["com.amazon.drm.PlainText@1.0", "com.amazon.drm.PlainText@2.0"]:
@@ -1068,7 +1112,7 @@ class DrmIon(object):
                             plaintext = self.ion.lobvalue()
 
                     if plaintext is not None:
-                        self.processpage(plaintext, None, outpages, decompress, decrypt)
+                        yield PageRec(plaintext, None, decompress, decrypt)
                     self.ion.stepout()
 
             self.ion.stepout()
@@ -1079,27 +1123,27 @@ class DrmIon(object):
     def print_(self, lst):
         self.ion.print_(lst)
 
-    def processpage(self, ct, civ, outpages, decompress, decrypt):
-        if decrypt:
-            aes = AES.new(self.key[:16], AES.MODE_CBC, civ[:16])
-            msg = pkcs7unpad(aes.decrypt(ct), 16)
+    def decodepage(self, page):
+        if page.decrypt:
+            aes = AES.new(self.key[:16], AES.MODE_CBC, page.iv[:16])
+            msg = pkcs7unpad(aes.decrypt(page.data), 16)
         else:
-            msg = ct
+            msg = page.data
 
-        if not decompress:
-            outpages.write(msg)
-            return
+        if not page.decompress:
+            return msg
 
         _assert(msg[0] == 0, "LZMA UseFilter not supported")
 
         if calibre_lzma is not None:
             with calibre_lzma.decompress(msg[1:], bufsize=0x1000000) as f:
                 f.seek(0)
-                outpages.write(f.read())
-            return
+                return f.read()
 
+        segments = []
         decomp = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
         while not decomp.eof:
             segment = decomp.decompress(msg[1:])
             msg = b"" # Contents were internally buffered after the first call
-            outpages.write(segment)
+            segments.append(segment)
+        return b"".join(segments)
@@ -5,7 +5,7 @@
 # Copyright © 2008-2020 by Apprentice Harper et al.
 
 __license__ = 'GPL v3'
-__version__ = '6.0'
+__version__ = '6.1'
 
 # Engine to remove drm from Kindle and Mobipocket ebooks
 # for personal use for archiving and converting your ebooks
@@ -61,6 +61,7 @@ __version__ = '6.0'
 #  5.6 - Invoke KFXZipBook to handle zipped KFX files
 #  5.7 - Revamp cleanup_name
 #  6.0 - Added Python 3 compatibility for calibre 5.0
+#  6.1 - Accept Kindle for PC/Mac KFX books as a folder or .azw with its sidecar folder
 
 
 import sys, os, re
@@ -199,19 +200,24 @@ def unescape(text):
 
 def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime = time.time()):
     # handle the obvious cases at the beginning
-    if not os.path.isfile(infile):
+    # a Kindle for PC/Mac book folder is read in place
+    isdir = os.path.isdir(infile)
+    if isdir:
+        magic8 = b''
+    elif not os.path.isfile(infile):
         raise DrmException("Input file does not exist.")
+    else:
+        magic8 = open(infile,'rb').read(8)
 
     mobi = True
-    magic8 = open(infile,'rb').read(8)
-    if magic8 == b'\xeaDRMION\xee':
-        raise DrmException("The .kfx DRMION file cannot be decrypted by itself. A .kfx-zip archive containing a DRM voucher is required.")
+    if magic8 == b'\xeaDRMION\xee' and not kfxdedrm.isKFXBookDir(infile):
+        raise DrmException("The .kfx DRMION file cannot be decrypted by itself. A .kfx-zip archive or .sdr folder containing a DRM voucher is required.")
 
     magic3 = magic8[:3]
     if magic3 == b'TPZ':
         mobi = False
 
-    if magic8[:4] == b'PK\x03\x04':
+    if isdir or magic8[:4] == b'PK\x03\x04' or magic8 == b'\xeaDRMION\xee':
         mb = kfxdedrm.KFXZipBook(infile)
     elif mobi:
         mb = mobidedrm.MobiBook(infile)
@@ -6,8 +6,15 @@
 #  2.0   - Python 3 for calibre 5.0
 #  2.1   - Some fixes for debugging
 #  2.1.1 - Whitespace!
+#  2.2   - Stream decrypted DRMION members straight into the output archive
+#  2.3   - Find the voucher in the same pass and parse it only once
+#  2.4   - Read Kindle for PC/Mac books in place from the .azw and its sidecar folder
+#  2.5   - Compress written members by the shared compression policy
+#  2.6   - Deflate large members in parallel blocks
 
 
+import collections
+import copy
 import os
 import shutil
 import traceback
@@ -16,56 +23,120 @@ import zipfile
 from io import BytesIO
 try:
     from ion import DrmIon, DrmIonVoucher
+    from ziputils import copyrawmember, writerawmember, writefile, setchecksum, spoolfile, readchunks
+    from ziputils import MemberSlice, getpolicy
 except:
     from calibre_plugins.dedrm.ion import DrmIon, DrmIonVoucher
+    from calibre_plugins.dedrm.ziputils import copyrawmember, writerawmember, writefile, setchecksum, spoolfile, readchunks
+    from calibre_plugins.dedrm.ziputils import MemberSlice, getpolicy
 
 
 __license__ = 'GPL v3'
-__version__ = '2.0'
+__version__ = '2.6'
+
+
+def sidecarpath(infile):
+    # Kindle for PC/Mac keep the book's assets and voucher next to the main file
+    return os.path.splitext(infile)[0] + '.sdr'
+
+
+def isKFXBookDir(infile):
+    return os.path.isdir(infile) or os.path.isdir(sidecarpath(infile))
+
+
+class KFXBookDir:
+    """
+    A book folder (or main .azw file plus its .sdr sidecar folder) read in
+    place with the same interface as the ZipFile of a .kfx-zip archive.
+    """
+    def __init__(self, infile):
+        if os.path.isdir(infile):
+            self.root = infile
+            paths = self.walk(infile)
+        else:
+            self.root = os.path.dirname(infile)
+            paths = [infile] + self.walk(sidecarpath(infile))
+
+        self.paths = collections.OrderedDict()
+        for path in paths:
+            name = os.path.relpath(path, self.root).replace(os.sep, '/')
+            self.paths[name] = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def walk(self, top):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                paths.append(os.path.join(dirpath, filename))
+        return paths
+
+    def namelist(self):
+        return list(self.paths)
+
+    def infolist(self):
+        return [self.getinfo(name) for name in self.paths]
+
+    def getinfo(self, name):
+        return zipfile.ZipInfo.from_file(self.paths[name], name)
+
+    def getpath(self, name):
+        return self.paths[name]
+
+    def open(self, name):
+        if isinstance(name, zipfile.ZipInfo):
+            name = name.filename
+        return open(self.paths[name], 'rb')
 
 
 class KFXZipBook:
     def __init__(self, infile):
         self.infile = infile
+        self.isdir = not zipfile.is_zipfile(infile) and isKFXBookDir(infile)
         self.voucher = None
-        self.decrypted = {}
+        self.vouchername = None
+        self.voucherdata = None
+        self.encrypted = set()
 
     def getPIDMetaInfo(self):
         return (None, None)
 
     def processBook(self, totalpids):
-        with zipfile.ZipFile(self.infile, 'r') as zf:
+        # only locate the DRMION members and the voucher here, the members
+        # are decrypted page by page straight into the output archive by getFile
+        with self.openbook() as zf:
             for filename in zf.namelist():
                 with zf.open(filename) as fh:
                     data = fh.read(8)
-                    if data != b'\xeaDRMION\xee':
-                        continue
-                    data += fh.read()
-                    if self.voucher is None:
-                        self.decrypt_voucher(totalpids)
-                    print("Decrypting KFX DRMION: {0}".format(filename))
-                    outfile = BytesIO()
-                    DrmIon(BytesIO(data[8:-8]), lambda name: self.voucher).parse(outfile)
-                    self.decrypted[filename] = outfile.getvalue()
-
-        if not self.decrypted:
-            print("The .kfx-zip archive does not contain an encrypted DRMION file")
+                    if data == b'\xeaDRMION\xee':
+                        self.encrypted.add(filename)
+                    elif data[:4] == b'\xe0\x01\x00\xea' and self.voucherdata is None:
+                        data += fh.read()
+                        if b'ProtectedData' in data:
+                            # found DRM voucher
+                            self.vouchername = filename
+                            self.voucherdata = data
+
+        if not self.encrypted:
+            print("The {0} does not contain an encrypted DRMION file".format(self.getContainerName()))
+        else:
+            self.decrypt_voucher(totalpids)
 
     def decrypt_voucher(self, totalpids):
-        with zipfile.ZipFile(self.infile, 'r') as zf:
-            for info in zf.infolist():
-                with zf.open(info.filename) as fh:
-                    data = fh.read(4)
-                    if data != b'\xe0\x01\x00\xea':
-                        continue
-
-                    data += fh.read()
-                    if b'ProtectedData' in data:
-                        break   # found DRM voucher
-            else:
-                raise Exception("The .kfx-zip archive contains an encrypted DRMION file without a DRM voucher")
+        if self.voucherdata is None:
+            raise Exception("The {0} contains an encrypted DRMION file without a DRM voucher".format(self.getContainerName()))
+
+        print("Decrypting KFX DRM voucher: {0}".format(self.vouchername))
 
-        print("Decrypting KFX DRM voucher: {0}".format(info.filename))
+        # the envelope is parsed once, each candidate only costs a key
+        # derivation and a single block decryption
+        voucher = DrmIonVoucher(BytesIO(self.voucherdata), '', '')
+        voucher.parse()
 
         for pid in [''] + totalpids:
             # Belt and braces. PIDs should be unicode strings, but just in case...
@@ -77,12 +148,15 @@ class KFXZipBook:
             else:
                 continue
 
+            voucher.setsecret(pid[:dsn_len], pid[dsn_len:])
+            if not voucher.checkkey():
+                continue
+
             try:
-                voucher = DrmIonVoucher(BytesIO(data), pid[:dsn_len], pid[dsn_len:])
-                voucher.parse()
                 voucher.decryptvoucher()
                 break
             except:
+                # the padding matched by chance
                 traceback.print_exc()
                 pass
         else:
@@ -97,6 +171,16 @@ class KFXZipBook:
 
         self.voucher = voucher
 
+    def openbook(self):
+        if self.isdir:
+            return KFXBookDir(self.infile)
+        return zipfile.ZipFile(self.infile, 'r')
+
+    def getContainerName(self):
+        if self.isdir:
+            return "Kindle book folder"
+        return ".kfx-zip archive"
+
     def getBookTitle(self):
         return os.path.splitext(os.path.split(self.infile)[1])[0]
 
@@ -110,10 +194,28 @@ class KFXZipBook:
         pass
 
     def getFile(self, outpath):
-        if not self.decrypted:
+        if not self.encrypted and not self.isdir:
             shutil.copyfile(self.infile, outpath)
         else:
-            with zipfile.ZipFile(self.infile, 'r') as zif:
+            with self.openbook() as zif:
                 with zipfile.ZipFile(outpath, 'w') as zof:
                     for info in zif.infolist():
-                        zof.writestr(info, self.decrypted.get(info.filename, zif.read(info.filename)))
+                        if info.filename not in self.encrypted:
+                            if self.isdir:
+                                writefile(zof, zif.getpath(info.filename), info.filename)
+                            else:
+                                copyrawmember(zif, zof, info)
+                            continue
+
+                        print("Decrypting KFX DRMION: {0}".format(info.filename))
+                        # compressed into a spool file first, so the member can be
+                        # deflated in parallel blocks and its header written once
+                        with zif.open(info) as fh, spoolfile() as spool:
+                            outfile = getpolicy().writer(info.filename, spool)
+                            # skip the DRMION signature and trailer
+                            DrmIon(MemberSlice(fh, 8, info.file_size - 16), lambda name: self.voucher).parse(outfile)
+                            outfile.finish()
+                            zi = copy.copy(info)
+                            setchecksum(zi, outfile)
+                            spool.seek(0)
+                            writerawmember(zof, zi, readchunks(spool))
@@ -9,15 +9,22 @@ def load_libcrypto():
     from ctypes.util import find_library
     import sys
 
+    # OpenSSL 1.1 and 3 renamed the Windows DLLs
     if sys.platform.startswith('win'):
-        libcrypto = find_library('libeay32')
+        names = ('libcrypto-3-x64', 'libcrypto-3', 'libcrypto-1_1-x64', 'libcrypto-1_1', 'libeay32')
+    else:
+        names = ('crypto',)
+    for name in names:
+        libcrypto = find_library(name)
+        if libcrypto is not None:
+            break
     else:
-        libcrypto = find_library('crypto')
-
-    if libcrypto is None:
         return None
 
-    libcrypto = CDLL(libcrypto)
+    try:
+        libcrypto = CDLL(libcrypto)
+    except OSError:
+        return None
 
     # typedef struct DES_ks
     #     {
@@ -58,11 +65,61 @@ def load_libcrypto():
         func.argtypes = argtypes
         return func
 
-    DES_set_key = F(None, 'DES_set_key',[c_char_p, DES_KEY_SCHEDULE_p])
-    DES_ecb_encrypt = F(None, 'DES_ecb_encrypt',[c_char_p, c_char_p, DES_KEY_SCHEDULE_p, c_int])
+    # Prefer the EVP interface, which decrypts a whole buffer in one call.
+    # OpenSSL 3 only has DES in its legacy provider, so check it works.
+    try:
+        EVP_CIPHER_CTX_new = F(c_void_p, 'EVP_CIPHER_CTX_new', [])
+        EVP_CIPHER_CTX_free = F(None, 'EVP_CIPHER_CTX_free', [c_void_p])
+        EVP_des_ecb = F(c_void_p, 'EVP_des_ecb', [])
+        EVP_DecryptInit_ex = F(c_int, 'EVP_DecryptInit_ex',
+                               [c_void_p, c_void_p, c_void_p, c_char_p, c_char_p])
+        EVP_CIPHER_CTX_set_padding = F(c_int, 'EVP_CIPHER_CTX_set_padding', [c_void_p, c_int])
+        EVP_DecryptUpdate = F(c_int, 'EVP_DecryptUpdate',
+                              [c_void_p, c_char_p, POINTER(c_int), c_char_p, c_int])
+    except AttributeError:
+        EVP_CIPHER_CTX_new = None
+
+    class EVP_DES(object):
+        api = 'EVP'
+        def __init__(self, key):
+            if len(key) != 8 :
+                raise Exception('DES improper key used')
+            self.key = key
+            self.ctx = EVP_CIPHER_CTX_new()
+            if not self.ctx:
+                raise Exception('DES context not allocated')
+            if not EVP_DecryptInit_ex(self.ctx, EVP_des_ecb(), None, key, None):
+                raise Exception('DES not available from libcrypto')
+            EVP_CIPHER_CTX_set_padding(self.ctx, 0)
+        def decrypt(self, data):
+            if not data:
+                return b''
+            ob = create_string_buffer(len(data) + 8)
+            outlen = c_int(0)
+            if not EVP_DecryptUpdate(self.ctx, ob, outlen, data, len(data)):
+                raise Exception('DES decryption failed')
+            return ob.raw[:outlen.value]
+        def __del__(self):
+            if getattr(self, 'ctx', None):
+                EVP_CIPHER_CTX_free(self.ctx)
+                self.ctx = None
+
+    if EVP_CIPHER_CTX_new is not None:
+        try:
+            EVP_DES(b'\0' * 8)
+            return EVP_DES
+        except Exception:
+            pass
+
+    try:
+        DES_set_key = F(None, 'DES_set_key',[c_char_p, DES_KEY_SCHEDULE_p])
+        DES_ecb_encrypt = F(None, 'DES_ecb_encrypt',[c_char_p, c_char_p, DES_KEY_SCHEDULE_p, c_int])
+    except AttributeError:
+        return None
 
 
     class DES(object):
+        api = 'DES_ecb_encrypt'
         def __init__(self, key):
             if len(key) != 8 :
                 raise Exception('DES improper key used')
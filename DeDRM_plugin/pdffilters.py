@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pdffilters.py
+# Copyright © 2020 by Apprentice Harper et al.
+
+# Released under the terms of the GNU General Public Licence, version 3
+# <http://www.gnu.org/licenses/>
+
+# Revision history:
+#   1.0 - Stream filters and predictors split out of ineptpdf, with
+#         all PNG predictors, TIFF predictor 2 and a working LZW decoder
+
+"""
+Decode PDF stream filters and predictors.
+"""
+
+__license__ = 'GPL v3'
+__version__ = "1.0"
+
+import struct
+from base64 import a85decode
+
+WHITESPACE = b' \t\n\r\f\v\0'
+
+
+# ASCII85Decode: data runs up to the ~> end-of-data marker
+def ascii85decode(data):
+    data = data.lstrip(WHITESPACE)
+    if data.startswith(b'<~'):
+        data = data[2:]
+    end = data.find(b'~>')
+    if end >= 0:
+        data = data[:end]
+    return a85decode(data, ignorechars=WHITESPACE)
+
+
+# ASCIIHexDecode: data runs up to >, with a missing final digit taken as 0
+def asciihexdecode(data):
+    end = data.find(b'>')
+    if end >= 0:
+        data = data[:end]
+    data = data.translate(None, WHITESPACE)
+    if len(data) % 2:
+        data += b'0'
+    return bytes.fromhex(data.decode('ascii'))
+
+
+# LZWDecode: codes start at 9 bits and grow to 12, 256 clears the table
+# and 257 ends the data. With EarlyChange (the default) the code width
+# grows one code sooner than strictly necessary.
+def lzwdecode(data, earlychange=1):
+    out = bytearray()
+    table = [bytes([i]) for i in range(256)] + [b'', b'']
+    nbits = 9
+    prev = None
+    bits = 0
+    nbuffered = 0
+    for byte in data:
+        bits = (bits << 8) | byte
+        nbuffered += 8
+        while nbuffered >= nbits:
+            nbuffered -= nbits
+            code = bits >> nbuffered
+            bits &= (1 << nbuffered) - 1
+            if code == 256:
+                del table[258:]
+                nbits = 9
+                prev = None
+                continue
+            if code == 257:
+                return bytes(out)
+            if code < len(table):
+                entry = table[code]
+                if prev is not None and len(table) < 4096:
+                    table.append(prev + entry[:1])
+            elif code == len(table) and prev is not None:
+                entry = prev + prev[:1]
+                table.append(entry)
+            else:
+                raise ValueError('Invalid LZW code: %d' % code)
+            out += entry
+            prev = entry
+            if nbits < 12 and len(table) + earlychange >= (1 << nbits):
+                nbits += 1
+    return bytes(out)
+
+
+# The PNG predictors (10 and up) tag every row with its own filter type:
+# 0 None, 1 Sub, 2 Up, 3 Average, 4 Paeth.
+def pngpredict(data, colors=1, bpc=8, columns=1):
+    bpp = max(1, (colors * bpc + 7) // 8)
+    rowlen = (colors * bpc * columns + 7) // 8
+    stride = rowlen + 1
+    nrows = (len(data) + rowlen) // stride
+    out = bytearray(nrows * rowlen)
+    prior = bytearray(rowlen)
+    size = 0
+    for r in range(nrows):
+        i = r * stride
+        ftype = data[i]
+        row = bytearray(data[i+1:i+stride])
+        size += len(row)
+        if len(row) < rowlen:
+            row.extend(bytes(rowlen - len(row)))
+        if ftype == 1:
+            for x in range(bpp, rowlen):
+                row[x] = (row[x] + row[x-bpp]) & 255
+        elif ftype == 2:
+            row = bytearray((a + b) & 255 for (a, b) in zip(row, prior))
+        elif ftype == 3:
+            for x in range(bpp):
+                row[x] = (row[x] + (prior[x] >> 1)) & 255
+            for x in range(bpp, rowlen):
+                row[x] = (row[x] + ((row[x-bpp] + prior[x]) >> 1)) & 255
+        elif ftype == 4:
+            for x in range(rowlen):
+                if x >= bpp:
+                    a = row[x-bpp]
+                    c = prior[x-bpp]
+                else:
+                    a = c = 0
+                b = prior[x]
+                p = a + b - c
+                pa = abs(p - a)
+                pb = abs(p - b)
+                pc = abs(p - c)
+                if pa <= pb and pa <= pc:
+                    row[x] = (row[x] + a) & 255
+                elif pb <= pc:
+                    row[x] = (row[x] + b) & 255
+                else:
+                    row[x] = (row[x] + c) & 255
+        elif ftype != 0:
+            raise ValueError('Invalid PNG filter type: %d' % ftype)
+        out[r*rowlen:(r+1)*rowlen] = row
+        prior = row
+    del out[size:]
+    return bytes(out)
+
+
+# TIFF predictor 2: each sample is stored as the difference from the same
+# colour component of the sample to its left in the row.
+def tiffpredict(data, colors=1, bpc=8, columns=1):
+    rowlen = (colors * bpc * columns + 7) // 8
+    out = bytearray(data)
+    if bpc == 8:
+        for start in range(0, len(out), rowlen):
+            for x in range(start + colors, min(start + rowlen, len(out))):
+                out[x] = (out[x] + out[x-colors]) & 255
+        return bytes(out)
+    if bpc == 16:
+        for start in range(0, len(out) - 1, rowlen):
+            end = min(start + rowlen, len(out)) & ~1
+            row = list(struct.unpack_from('>%dH' % ((end - start) // 2), out, start))
+            for x in range(colors, len(row)):
+                row[x] = (row[x] + row[x-colors]) & 0xffff
+            struct.pack_into('>%dH' % len(row), out, start, *row)
+        return bytes(out)
+    if bpc not in (1, 2, 4):
+        raise ValueError('Unsupported bits per component: %d' % bpc)
+    # samples smaller than a byte, unpacked a row at a time
+    mask = (1 << bpc) - 1
+    nsamples = colors * columns
+    for start in range(0, len(out), rowlen):
+        row = int.from_bytes(out[start:start+rowlen], 'big')
+        nbits = 8 * len(out[start:start+rowlen])
+        samples = [(row >> (nbits - (x + 1) * bpc)) & mask
+                   for x in range(min(nsamples, nbits // bpc))]
+        for x in range(colors, len(samples)):
+            samples[x] = (samples[x] + samples[x-colors]) & mask
+        row = 0
+        for sample in samples:
+            row = (row << bpc) | sample
+        row <<= nbits - len(samples) * bpc
+        out[start:start+rowlen] = row.to_bytes(nbits // 8, 'big')
+    return bytes(out)
+
+
+def predict(data, predictor, colors=1, bpc=8, columns=1):
+    if predictor == 1:
+        return data
+    if predictor == 2:
+        return tiffpredict(data, colors, bpc, columns)
+    if predictor >= 10:
+        return pngpredict(data, colors, bpc, columns)
+    raise ValueError('Unsupported predictor: %r' % predictor)
@@ -21,6 +21,8 @@ class DeDRM_Prefs():
         self.dedrmprefs.defaults['configured'] = False
         self.dedrmprefs.defaults['bandnkeys'] = {}
         self.dedrmprefs.defaults['adeptkeys'] = {}
+        # the ADE user UUID each Adobe key belongs to, by hex key value
+        self.dedrmprefs.defaults['adeptkeyuuids'] = {}
         self.dedrmprefs.defaults['ereaderkeys'] = {}
         self.dedrmprefs.defaults['kindlekeys'] = {}
         self.dedrmprefs.defaults['androidkeys'] = {}
@@ -28,6 +30,8 @@ class DeDRM_Prefs():
         self.dedrmprefs.defaults['serials'] = []
         self.dedrmprefs.defaults['adobewineprefix'] = ""
         self.dedrmprefs.defaults['kindlewineprefix'] = ""
+        # store media and deflate at the fastest level when rewriting archives
+        self.dedrmprefs.defaults['fastcompression'] = False
 
         # initialise
         # we must actually set the prefs that are dictionaries and lists
@@ -37,6 +41,8 @@ class DeDRM_Prefs():
             self.dedrmprefs['bandnkeys'] = {}
         if self.dedrmprefs['adeptkeys'] == {}:
             self.dedrmprefs['adeptkeys'] = {}
+        if self.dedrmprefs['adeptkeyuuids'] == {}:
+            self.dedrmprefs['adeptkeyuuids'] = {}
         if self.dedrmprefs['ereaderkeys'] == {}:
             self.dedrmprefs['ereaderkeys'] = {}
         if self.dedrmprefs['kindlekeys'] == {}:
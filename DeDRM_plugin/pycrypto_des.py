@@ -18,7 +18,10 @@ def load_pycrypto():
             return self._des.decrypt(data)
         def decrypt(self, data):
             if not data:
-                return ''
+                return b''
+            if len(data) % 8 == 0:
+                # whole blocks go through in one call
+                return self._des.decrypt(data)
             i = 0
             result = []
             while i < len(data):
@@ -26,5 +29,5 @@ def load_pycrypto():
                 processed_block = self.desdecrypt(block)
                 result.append(processed_block)
                 i += 8
-            return ''.join(result)
+            return b''.join(result)
     return DES
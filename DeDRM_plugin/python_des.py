@@ -100,7 +100,7 @@ class Des(object):
         pos = 0
         for c in data:
             i = 7
-            ch = ord(c)
+            ch = c if isinstance(c, int) else ord(c)
             while i >= 0:
                 if ch & (1 << i) != 0:
                     result[pos] = 1
@@ -110,16 +110,16 @@ class Des(object):
                 i -= 1
         return result
     def __BitList_to_String(self, data):
-        result = ''
+        result = bytearray()
         pos = 0
         c = 0
         while pos < len(data):
             c += data[pos] << (7 - (pos % 8))
             if (pos % 8) == 7:
-                result += chr(c)
+                result.append(c)
                 c = 0
             pos += 1
-        return result
+        return bytes(result)
     def __permutate(self, table, block):
         return [block[x] for x in table]
     def __create_sub_keys(self):
@@ -175,7 +175,7 @@ class Des(object):
         return self.final
     def crypt(self, data, crypt_type):
         if not data:
-            return ''
+            return b''
         if len(data) % self.block_size != 0:
             if crypt_type == Des.DECRYPT: # Decryption must work on 8 byte blocks
                 raise ValueError("Invalid data length, data must be a multiple of " + str(self.block_size) + " bytes\n.")
@@ -211,7 +211,7 @@ class Des(object):
             while s[-1] == self.getPadding():
                 s = s[:-1]
             result[-1] = s
-        return ''.join(result)
+        return b''.join(result)
     def encrypt(self, data, pad=''):
         self.__padding = pad
         return self.crypt(data, Des.ENCRYPT)
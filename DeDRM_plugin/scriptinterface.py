@@ -14,18 +14,25 @@ import calibre_plugins.dedrm.zipfix
 import calibre_plugins.dedrm.ineptpdf
 import calibre_plugins.dedrm.erdr2pml
 import calibre_plugins.dedrm.k4mobidedrm
+try:
+    from zipfix import checkBook, repairBook
+except:
+    from calibre_plugins.dedrm.zipfix import checkBook, repairBook
 
 def decryptepub(infile, outdir, rscpath):
     errlog = ''
 
-    # first fix the epub to make sure we do not get errors
+    # first fix the epub to make sure we do not get errors,
+    # unless it needs no repair and can be used as it is
     name, ext = os.path.splitext(os.path.basename(infile))
     bpath = os.path.dirname(infile)
-    zippath = os.path.join(bpath,name + '_temp.zip')
-    rv = zipfix.repairBook(infile, zippath)
-    if rv != 0:
-        print("Error while trying to fix epub")
-        return rv
+    zippath = infile
+    if not checkBook(infile):
+        zippath = os.path.join(bpath,name + '_temp.zip')
+        rv = repairBook(infile, zippath)
+        if rv != 0:
+            print("Error while trying to fix epub")
+            return rv
 
     # determine a good name for the output file
     outfile = os.path.join(outdir, name + '_nodrm.epub')
@@ -78,7 +85,8 @@ def decryptepub(infile, outdir, rscpath):
         else:
             print("{0} has an unknown encryption.".format(name))
 
-    os.remove(zippath)
+    if zippath != infile:
+        os.remove(zippath)
     if rv != 0:
         print(errlog)
     return rv
@@ -97,17 +105,14 @@ def decryptpdf(infile, outdir, rscpath):
     filefilter = re.compile("\.der$", re.IGNORECASE)
     files = filter(filefilter.search, files)
     if files:
-        for filename in files:
-            keypath = os.path.join(rscpath, filename)
-            userkey = open(keypath,'rb').read()
-            try:
-                rv = ineptpdf.decryptBook(userkey, infile, outfile)
-                if rv == 0:
-                    break
-            except Exception as e:
-                errlog += traceback.format_exc()
-                errlog += str(e)
-                rv = 1
+        userkeys = [open(os.path.join(rscpath, filename),'rb').read() for filename in files]
+        # the pdf is parsed once and each key tried on it in turn
+        try:
+            rv = ineptpdf.decryptBookWithKeys(userkeys, infile, outfile)[0]
+        except Exception as e:
+            errlog += traceback.format_exc()
+            errlog += str(e)
+            rv = 1
 
     if rv != 0:
         print(errlog)
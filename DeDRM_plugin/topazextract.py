@@ -8,8 +8,10 @@
 #  4.9  - moved unicode_argv call inside main for Windows DeDRM compatibility
 #  5.0  - Fixed potential unicode problem with command line interface
 #  6.0  - Added Python 3 compatibility for calibre 5.0
+#  6.1  - Compress members by the shared compression policy
+#  6.2  - Deflate large files in parallel blocks
 
-__version__ = '6.0'
+__version__ = '6.2'
 
 import sys
 import os, csv, getopt
@@ -19,8 +21,10 @@ from struct import pack
 from struct import unpack
 try:
     from calibre_plugins.dedrm.alfcrypto import Topaz_Cipher
+    from calibre_plugins.dedrm.ziputils import writefile
 except:
     from alfcrypto import Topaz_Cipher
+    from ziputils import writefile
 
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
@@ -94,6 +98,10 @@ class DrmException(Exception):
     pass
 
 
+# add a file to the zip, compressed as the compression policy says
+def zipUpFile(myzip, tdir, localname):
+    writefile(myzip, os.path.join(tdir,localname), localname)
+
 # recursive zip creation support routine
 def zipUpDir(myzip, tdir, localname):
     currentdir = tdir
@@ -105,7 +113,7 @@ def zipUpDir(myzip, tdir, localname):
         localfilePath = os.path.join(localname, afilename)
         realfilePath = os.path.join(currentdir,file)
         if os.path.isfile(realfilePath):
-            myzip.write(realfilePath, localfilePath)
+            zipUpFile(myzip, tdir, localfilePath)
         elif os.path.isdir(realfilePath):
             zipUpDir(myzip, tdir, localfilePath)
 
@@ -421,11 +429,11 @@ class TopazBook:
 
     def getFile(self, zipname):
         htmlzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
-        htmlzip.write(os.path.join(self.outdir,"book.html"),"book.html")
-        htmlzip.write(os.path.join(self.outdir,"book.opf"),"book.opf")
+        zipUpFile(htmlzip, self.outdir, "book.html")
+        zipUpFile(htmlzip, self.outdir, "book.opf")
         if os.path.isfile(os.path.join(self.outdir,"cover.jpg")):
-            htmlzip.write(os.path.join(self.outdir,"cover.jpg"),"cover.jpg")
-        htmlzip.write(os.path.join(self.outdir,"style.css"),"style.css")
+            zipUpFile(htmlzip, self.outdir, "cover.jpg")
+        zipUpFile(htmlzip, self.outdir, "style.css")
         zipUpDir(htmlzip, self.outdir, "img")
         htmlzip.close()
 
@@ -437,7 +445,7 @@ class TopazBook:
 
     def getSVGZip(self, zipname):
         svgzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
-        svgzip.write(os.path.join(self.outdir,"index_svg.xhtml"),"index_svg.xhtml")
+        zipUpFile(svgzip, self.outdir, "index_svg.xhtml")
         zipUpDir(svgzip, self.outdir, "svg")
         zipUpDir(svgzip, self.outdir, "img")
         svgzip.close()
@@ -7,9 +7,9 @@ Read and write ZIP files.
 import struct, os, time, sys, shutil
 import binascii, stat
 import io
+import mmap
 import re
 
-from io import BytesIO
 
 try:
     import zlib # We may need its compression method
@@ -37,6 +37,9 @@ ZIP64_LIMIT = (1 << 31) - 1
 ZIP_FILECOUNT_LIMIT = 1 << 16
 ZIP_MAX_COMMENT = (1 << 16) - 1
 
+# header id of the ZIP64 extended information extra field
+ZIP64_EXTRA = 0x0001
+
 # constants for Zip file compression methods
 ZIP_STORED = 0
 ZIP_DEFLATED = 8
@@ -192,6 +195,18 @@ def _EndRecData64(fpin, offset, endrec):
     return endrec
 
 
+def _strip_extra(extra, xids):
+    """Remove the extra field records with the given header ids."""
+    result = []
+    pos = 0
+    while pos + 4 <= len(extra):
+        xid, xlen = struct.unpack('<HH', extra[pos:pos+4])
+        if xid not in xids:
+            result.append(extra[pos:pos+4+xlen])
+        pos += 4 + xlen
+    return b''.join(result)
+
+
 def _EndRecData(fpin):
     """Return data from the "End of Central Directory" record, or None.
 
@@ -210,13 +225,13 @@ def _EndRecData(fpin):
     except IOError:
         return None
     data = fpin.read()
-    if data[0:4] == stringEndArchive and data[-2:] == "\000\000":
+    if data[0:4] == stringEndArchive and data[-2:] == b"\000\000":
         # the signature is correct and there's no comment, unpack structure
         endrec = struct.unpack(structEndArchive, data)
         endrec=list(endrec)
 
         # Append a blank comment and record start offset
-        endrec.append("")
+        endrec.append(b"")
         endrec.append(filesize - sizeEndCentDir)
 
         # Try to read the "Zip64 end of central directory" structure
@@ -313,8 +328,11 @@ class ZipInfo (object):
         # compress_size         Size of the compressed file
         # file_size             Size of the uncompressed file
 
-    def FileHeader(self):
-        """Return the per-file header as a string."""
+    def FileHeader(self, zip64=None):
+        """Return the per-file header as a string.
+
+        zip64 forces (True) or prevents (False) a ZIP64 extra field, which
+        is otherwise added only when the sizes need it."""
         dt = self.date_time
         dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
         dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
@@ -326,18 +344,22 @@ class ZipInfo (object):
             compress_size = self.compress_size
             file_size = self.file_size
 
-        extra = self.extra
+        extra = _strip_extra(self.extra, (ZIP64_EXTRA,))
 
-        if file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT:
+        if zip64 is None:
+            zip64 = file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT
+        if zip64:
             # File is larger than what fits into a 4 byte integer,
             # fall back to the ZIP64 extension
             fmt = '<HHQQ'
             extra = extra + struct.pack(fmt,
-                    1, struct.calcsize(fmt)-4, file_size, compress_size)
+                    ZIP64_EXTRA, struct.calcsize(fmt)-4, file_size, compress_size)
             file_size = 0xffffffff
             compress_size = 0xffffffff
             self.extract_version = max(45, self.extract_version)
             self.create_version = max(45, self.extract_version)
+        elif file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT:
+            raise LargeZipFile("Filesize would require ZIP64 extensions")
 
         filename, flag_bits = self._encodeFilenameFlags()
         header = struct.pack(structFileHeader, stringFileHeader,
@@ -360,33 +382,27 @@ class ZipInfo (object):
         # Try to decode the extra field.
         extra = self.extra
         unpack = struct.unpack
-        while extra:
+        while len(extra) >= 4:
             tp, ln = unpack('<HH', extra[:4])
-            if tp == 1:
-                if ln >= 24:
-                    counts = unpack('<QQQ', extra[4:28])
-                elif ln == 16:
-                    counts = unpack('<QQ', extra[4:20])
-                elif ln == 8:
-                    counts = unpack('<Q', extra[4:12])
-                elif ln == 0:
-                    counts = ()
-                else:
-                    raise RuntimeError("Corrupt extra field %s"%(ln,))
+            if tp == ZIP64_EXTRA:
+                # the values present are the ones whose 32 bit fields
+                # are all ones, in this order. a short or odd length
+                # field only supplies what it has room for.
+                data = extra[4:4+ln]
+                counts = unpack('<%dQ' % (len(data) // 8), data[:len(data) // 8 * 8])
 
                 idx = 0
 
                 # ZIP64 extension (large files and/or large archives)
-                if self.file_size in (0xffffffffffffffff, 0xffffffff):
+                if self.file_size in (0xffffffffffffffff, 0xffffffff) and idx < len(counts):
                     self.file_size = counts[idx]
                     idx += 1
 
-                if self.compress_size == 0xFFFFFFFF:
+                if self.compress_size == 0xFFFFFFFF and idx < len(counts):
                     self.compress_size = counts[idx]
                     idx += 1
 
-                if self.header_offset == 0xffffffff:
-                    old = self.header_offset
+                if self.header_offset == 0xffffffff and idx < len(counts):
                     self.header_offset = counts[idx]
                     idx+=1
 
@@ -463,12 +479,17 @@ class ZipExtFile(io.BufferedIOBase):
     # Read from compressed files in 4k blocks.
     MIN_READ_SIZE = 4096
 
+    # Never read more than this from the archive at a time, so a member
+    # is streamed rather than read into memory whole.
+    MAX_READ_SIZE = 1 << 20
+
     # Search for universal newlines or line chunks.
     PATTERN = re.compile(r'^(?P<chunk>[^\r\n]+)|(?P<newline>\n|\r\n?)')
 
-    def __init__(self, fileobj, mode, zipinfo, decrypter=None):
+    def __init__(self, fileobj, mode, zipinfo, decrypter=None, close_fileobj=False):
         self._fileobj = fileobj
         self._decrypter = decrypter
+        self._close_fileobj = close_fileobj
 
         self._compress_type = zipinfo.compress_type
         self._compress_size = zipinfo.compress_size
@@ -500,7 +521,7 @@ class ZipExtFile(io.BufferedIOBase):
 
         if not self._universal and limit < 0:
             # Shortcut common case - newline found in buffer.
-            i = self._readbuffer.find('\n', self._offset) + 1
+            i = self._readbuffer.find(b'\n', self._offset) + 1
             if i > 0:
                 line = self._readbuffer[self._offset: i]
                 self._offset = i
@@ -531,7 +552,7 @@ class ZipExtFile(io.BufferedIOBase):
                 if newline not in self.newlines:
                     self.newlines.append(newline)
                 self._offset += len(newline)
-                return line + '\n'
+                return line + b'\n'
 
             chunk = match.group('chunk')
             if limit >= 0:
@@ -559,15 +580,18 @@ class ZipExtFile(io.BufferedIOBase):
         If the argument is omitted, None, or negative, data is read and returned until EOF is reached..
         """
 
-        buf = b''
-        while n < 0 or n is None or n > len(buf):
-            data = self.read1(n)
+        if n is None:
+            n = -1
+        buf = []
+        size = 0
+        while n < 0 or n > size:
+            data = self.read1(n - size if n >= 0 else n)
             if len(data) == 0:
-                return buf
-
-            buf += data
+                break
+            buf.append(data)
+            size += len(data)
 
-        return buf
+        return b''.join(buf)
 
     def read1(self, n):
         """Read up to n bytes with at most one read() system call."""
@@ -583,7 +607,7 @@ class ZipExtFile(io.BufferedIOBase):
         if self._compress_left > 0 and n > len_readbuffer + len(self._unconsumed):
             nbytes = n - len_readbuffer - len(self._unconsumed)
             nbytes = max(nbytes, self.MIN_READ_SIZE)
-            nbytes = min(nbytes, self._compress_left)
+            nbytes = min(nbytes, self._compress_left, self.MAX_READ_SIZE)
 
             data = self._fileobj.read(nbytes)
             self._compress_left -= len(data)
@@ -618,6 +642,13 @@ class ZipExtFile(io.BufferedIOBase):
         self._offset += len(data)
         return data
 
+    def close(self):
+        try:
+            if self._close_fileobj:
+                self._fileobj.close()
+        finally:
+            super(ZipExtFile, self).close()
+
 
 
 class ZipFile:
@@ -736,22 +767,48 @@ class ZipFile:
             print("given, inferred, offset", offset_cd, inferred, concat)
         # self.start_dir:  Position of start of central directory
         self.start_dir = offset_cd + concat
-        fp.seek(self.start_dir, 0)
-        data = fp.read(size_cd)
-        fp = BytesIO(data)
-        total = 0
-        while total < size_cd:
-            centdir = fp.read(sizeCentralDir)
-            if centdir[0:4] != stringCentralDir:
+        data, mm = self._mapCentralDir(fp, size_cd)
+        try:
+            self._parseCentralDir(data, size_cd, concat)
+        finally:
+            if mm is not None:
+                mm.close()
+
+    def _mapCentralDir(self, fp, size_cd):
+        """Return the central directory as a buffer, and the mmap holding it
+        (or None if it had to be read into memory instead)."""
+        try:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, OSError, io.UnsupportedOperation):
+            fp.seek(self.start_dir, 0)
+            return fp.read(size_cd), None
+        if self.start_dir + size_cd > len(mm):
+            mm.close()
+            raise BadZipfile("Truncated central directory")
+        return mm, mm
+
+    def _parseCentralDir(self, data, size_cd, concat):
+        """Build the ZipInfo list from the central directory in data, which
+        is either the whole mapped file or just the directory itself."""
+        pos = self.start_dir if isinstance(data, mmap.mmap) else 0
+        end = pos + size_cd
+        if len(data) < end:
+            raise BadZipfile("Truncated central directory")
+        while pos < end:
+            if data[pos:pos+4] != stringCentralDir:
                 raise BadZipfile("Bad magic number for central directory")
-            centdir = struct.unpack(structCentralDir, centdir)
+            centdir = struct.unpack_from(structCentralDir, data, pos)
             if self.debug > 2:
                 print(centdir)
-            filename = fp.read(centdir[_CD_FILENAME_LENGTH])
+            pos += sizeCentralDir
+            filename = data[pos:pos+centdir[_CD_FILENAME_LENGTH]]
+            pos += centdir[_CD_FILENAME_LENGTH]
             # Create ZipInfo instance to store file information
             x = ZipInfo(filename)
-            x.extra = fp.read(centdir[_CD_EXTRA_FIELD_LENGTH])
-            x.comment = fp.read(centdir[_CD_COMMENT_LENGTH])
+            x.extra = data[pos:pos+centdir[_CD_EXTRA_FIELD_LENGTH]]
+            pos += centdir[_CD_EXTRA_FIELD_LENGTH]
+            x.comment = data[pos:pos+centdir[_CD_COMMENT_LENGTH]]
+            pos += centdir[_CD_COMMENT_LENGTH]
             x.header_offset = centdir[_CD_LOCAL_HEADER_OFFSET]
             (x.create_version, x.create_system, x.extract_version, x.reserved,
                 x.flag_bits, x.compress_type, t, d,
@@ -767,13 +824,8 @@ class ZipFile:
             self.filelist.append(x)
             self.NameToInfo[x.filename] = x
 
-            # update total bytes read from central directory
-            total = (total + sizeCentralDir + centdir[_CD_FILENAME_LENGTH]
-                     + centdir[_CD_EXTRA_FIELD_LENGTH]
-                     + centdir[_CD_COMMENT_LENGTH])
-
             if self.debug > 2:
-                print("total", total)
+                print("total", pos)
 
 
     def namelist(self):
@@ -892,7 +944,36 @@ class ZipFile:
             if ord(h[11]) != check_byte:
                 raise RuntimeError("Bad password for file", name)
 
-        return  ZipExtFile(zef_file, mode, zinfo, zd)
+        return  ZipExtFile(zef_file, mode, zinfo, zd,
+                           close_fileobj=not self._filePassed)
+
+    def _dataOffset(self, zinfo):
+        """Return the offset of the member's data, after its local header."""
+        self.fp.seek(zinfo.header_offset, 0)
+        fheader = self.fp.read(sizeFileHeader)
+        if fheader[0:4] != stringFileHeader:
+            raise BadZipfile("Bad magic number for file header")
+        fheader = struct.unpack(structFileHeader, fheader)
+        return (zinfo.header_offset + sizeFileHeader
+                + fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH])
+
+    def readraw(self, name, chunk_size=1 << 20):
+        """Yield the compressed bytes of a member, chunk_size at a time,
+        without decompressing them."""
+        if isinstance(name, ZipInfo):
+            zinfo = name
+        else:
+            zinfo = self.getinfo(name)
+        pos = self._dataOffset(zinfo)
+        remaining = zinfo.compress_size
+        while remaining > 0:
+            self.fp.seek(pos, 0)
+            data = self.fp.read(min(remaining, chunk_size))
+            if not data:
+                raise BadZipfile("Truncated data for %r" % (zinfo.filename,))
+            pos += len(data)
+            remaining -= len(data)
+            yield data
 
     def extract(self, member, path=None, pwd=None):
         """Extract a member from the archive to the current working directory,
@@ -980,7 +1061,7 @@ class ZipFile:
             if not self._allowZip64:
                 raise LargeZipFile("Zipfile size would require ZIP64 extensions")
 
-    def write(self, filename, arcname=None, compress_type=None):
+    def write(self, filename, arcname=None, compress_type=None, compresslevel=None):
         """Put the bytes from filename into the archive under the name
         arcname."""
         if not self.fp:
@@ -1009,6 +1090,8 @@ class ZipFile:
         zinfo.file_size = st.st_size
         zinfo.flag_bits = 0x00
         zinfo.header_offset = self.fp.tell()    # Start of header bytes
+        # the compressed size isn't known yet, so allow for some growth
+        zip64 = self._allowZip64 and zinfo.file_size * 1.05 > ZIP64_LIMIT
 
         self._writecheck(zinfo)
         self._didModify = True
@@ -1027,10 +1110,11 @@ class ZipFile:
             zinfo.CRC = CRC = 0
             zinfo.compress_size = compress_size = 0
             zinfo.file_size = file_size = 0
-            self.fp.write(zinfo.FileHeader())
+            self.fp.write(zinfo.FileHeader(zip64))
             if zinfo.compress_type == ZIP_DEFLATED:
-                cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                     zlib.DEFLATED, -15)
+                if compresslevel is None:
+                    compresslevel = zlib.Z_DEFAULT_COMPRESSION
+                cmpr = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
             else:
                 cmpr = None
             while 1:
@@ -1052,16 +1136,15 @@ class ZipFile:
             zinfo.compress_size = file_size
         zinfo.CRC = CRC
         zinfo.file_size = file_size
-        # Seek backwards and write CRC and file sizes
+        # Seek backwards and rewrite the header with CRC and file sizes
         position = self.fp.tell()       # Preserve current position in file
-        self.fp.seek(zinfo.header_offset + 14, 0)
-        self.fp.write(struct.pack("<LLL", zinfo.CRC, zinfo.compress_size,
-              zinfo.file_size))
+        self.fp.seek(zinfo.header_offset, 0)
+        self.fp.write(zinfo.FileHeader(zip64))
         self.fp.seek(position, 0)
         self.filelist.append(zinfo)
         self.NameToInfo[zinfo.filename] = zinfo
 
-    def writestr(self, zinfo_or_arcname, bytes, compress_type=None):
+    def writestr(self, zinfo_or_arcname, bytes, compress_type=None, compresslevel=None):
         """Write a file into the archive.  The contents is the string
         'bytes'.  'zinfo_or_arcname' is either a ZipInfo instance or
         the name of the file in the archive."""
@@ -1087,8 +1170,9 @@ class ZipFile:
         self._didModify = True
         zinfo.CRC = crc32(bytes) & 0xffffffff       # CRC-32 checksum
         if zinfo.compress_type == ZIP_DEFLATED:
-            co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                 zlib.DEFLATED, -15)
+            if compresslevel is None:
+                compresslevel = zlib.Z_DEFAULT_COMPRESSION
+            co = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
             bytes = co.compress(bytes) + co.flush()
             zinfo.compress_size = len(bytes)    # Compressed size
         else:
@@ -1104,6 +1188,44 @@ class ZipFile:
         self.filelist.append(zinfo)
         self.NameToInfo[zinfo.filename] = zinfo
 
+    def writeraw(self, zinfo, chunks):
+        """Write a member whose data is already compressed.
+
+        zinfo must carry the member's compress_type, CRC and sizes, and
+        the iterable chunks its compressed bytes, which are written to
+        the archive as they are."""
+        if not self.fp:
+            raise RuntimeError(
+                  "Attempt to write to ZIP archive that was already closed")
+        zinfo.flag_bits &= ~0x08
+        zinfo.header_offset = self.fp.tell()    # Start of header bytes
+        self._writecheck(zinfo)
+        if zinfo.compress_size > ZIP64_LIMIT and not self._allowZip64:
+            raise LargeZipFile("Filesize would require ZIP64 extensions")
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader())
+        for data in chunks:
+            self.fp.write(data)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+    def copyraw(self, source, name, arcname=None):
+        """Copy a member of another open ZipFile, source, into this archive
+        without decompressing and compressing it again."""
+        if isinstance(name, ZipInfo):
+            src = name
+        else:
+            src = source.getinfo(name)
+        zinfo = ZipInfo(src.filename if arcname is None else arcname, src.date_time)
+        for attr in ('compress_type', 'comment', 'extra', 'create_system',
+                     'create_version', 'extract_version', 'flag_bits',
+                     'internal_attr', 'external_attr', 'CRC',
+                     'compress_size', 'file_size'):
+            setattr(zinfo, attr, getattr(src, attr))
+        zinfo.extra = _strip_extra(zinfo.extra, (ZIP64_EXTRA,))
+        self.writeraw(zinfo, source.readraw(src))
+        return zinfo
+
     def __del__(self):
         """Call the "close()" method in case the user forgot."""
         self.close()
@@ -1139,12 +1261,12 @@ class ZipFile:
                 else:
                     header_offset = zinfo.header_offset
 
-                extra_data = zinfo.extra
+                extra_data = _strip_extra(zinfo.extra, (ZIP64_EXTRA,))
                 if extra:
                     # Append a ZIP64 field to the extra's
                     extra_data = struct.pack(
                             '<HH' + 'Q'*len(extra),
-                            1, 8*len(extra), *extra) + extra_data
+                            ZIP64_EXTRA, 8*len(extra), *extra) + extra_data
 
                     extract_version = max(45, zinfo.extract_version)
                     create_version = max(45, zinfo.create_version)
@@ -11,6 +11,11 @@
 #   1.0 - Initial release
 #   1.1 - Updated to handle zip file metadata correctly
 #   2.0 - Python 3 for calibre 5.0
+#   2.1 - Compress members by the shared compression policy
+#   2.2 - Tolerant reader so decryptors can read damaged archives directly
+#   2.3 - Copy archives that need no repair as they are, stream inflation
+#   2.4 - Copy member data raw when only the name or headers need repair
+#   2.5 - Deflate repaired members in parallel blocks
 
 """
 Re-write zip (or ePub) fixing problems with file names (and mimetype entry).
@@ -18,18 +23,25 @@ Re-write zip (or ePub) fixing problems with file names (and mimetype entry).
 
 
 __license__ = 'GPL v3'
-__version__ = "1.1"
+__version__ = "2.5"
 
 import sys
 import zlib
+import zipfile
+from io import BytesIO
 try:
     import zipfilerugged
 except:
     import calibre_plugins.dedrm.zipfilerugged as zipfilerugged
+try:
+    from ziputils import getpolicy, setchecksum, checksum
+except:
+    from calibre_plugins.dedrm.ziputils import getpolicy, setchecksum, checksum
 import os
 import os.path
 import getopt
-from struct import unpack
+import shutil
+from struct import unpack, Struct
 
 
 _FILENAME_LEN_OFFSET = 26
@@ -37,6 +49,19 @@ _EXTRA_LEN_OFFSET = 28
 _FILENAME_OFFSET = 30
 _MAX_SIZE = 64 * 1024
 _MIMETYPE = 'application/epub+zip'
+_LOCAL_HEADER = Struct('<4s2B4HL2L2H')
+_DATA_DESCRIPTOR = 0x08
+_ZIP64_SIZE = 0xFFFFFFFF
+
+
+def validextra(extra):
+    # an extra field must be a whole number of (id, length, data) records
+    pos = 0
+    while pos + 4 <= len(extra):
+        xlen, = unpack('<H', extra[pos+2:pos+4])
+        pos += 4 + xlen
+    return pos == len(extra)
+
 
 class ZipInfo(zipfilerugged.ZipInfo):
     def __init__(self, *args, **kwargs):
@@ -45,16 +70,62 @@ class ZipInfo(zipfilerugged.ZipInfo):
         super(ZipInfo, self).__init__(*args, **kwargs)
         self.compress_type = compress_type
 
+class TolerantZipFile(zipfile.ZipFile):
+    """
+    Read-only ZipFile that copes with the damage fixZip repairs.
+
+    A member whose local header name differs from its central directory
+    entry is known by its local name, just as fixZip renames it, so the
+    member can be read or copied raw without rewriting the archive first.
+    Like fixZip, members are read without checking their data against
+    the CRC in the headers, which copying corrects.
+    """
+    def __init__(self, file):
+        super(TolerantZipFile, self).__init__(file, 'r')
+        renamed = False
+        for zinfo in self.filelist:
+            local_name = self.getlocalname(zinfo)
+            if local_name is not None and local_name != zinfo.orig_filename:
+                zinfo.orig_filename = local_name
+                zinfo.filename = zipfile.ZipInfo(local_name).filename
+                renamed = True
+        if renamed:
+            self.NameToInfo = dict((zinfo.filename, zinfo) for zinfo in self.filelist)
+
+    def open(self, name, mode='r', pwd=None, **kwargs):
+        zef = super(TolerantZipFile, self).open(name, mode, pwd, **kwargs)
+        if mode == 'r' and hasattr(zef, '_expected_crc'):
+            # turn off the CRC check only, so the member stays seekable
+            zef._expected_crc = None
+        return zef
+
+    def getlocalname(self, zinfo):
+        # the member name from the local header, decoded as ZipFile.open does
+        self.fp.seek(zinfo.header_offset)
+        fheader = self.fp.read(_FILENAME_OFFSET)
+        if len(fheader) != _FILENAME_OFFSET or fheader[0:4] != zipfile.stringFileHeader:
+            return None
+        local_name_length, = unpack('<H', fheader[_FILENAME_LEN_OFFSET:_FILENAME_LEN_OFFSET+2])
+        local_name = self.fp.read(local_name_length)
+        if zinfo.flag_bits & 0x800:
+            return local_name.decode('utf-8', 'replace')
+        return local_name.decode('cp437')
+
+
 class fixZip:
-    def __init__(self, zinput, zoutput):
+    def __init__(self, zinput, zoutput=None):
         self.ztype = 'zip'
         if zinput.lower().find('.epub') >= 0 :
             self.ztype = 'epub'
         self.inzip = zipfilerugged.ZipFile(zinput,'r')
-        self.outzip = zipfilerugged.ZipFile(zoutput,'w')
+        self.zoutput = zoutput
         # open the input zip for reading only as a raw file
         self.bzf = open(zinput,'rb')
 
+    def close(self):
+        self.bzf.close()
+        self.inzip.close()
+
     def getlocalname(self, zi):
         local_header_offset = zi.header_offset
         self.bzf.seek(local_header_offset + _FILENAME_LEN_OFFSET)
@@ -66,22 +137,71 @@ class fixZip:
 
     def uncompress(self, cmpdata):
         dc = zlib.decompressobj(-15)
-        data = b''
-        while len(cmpdata) > 0:
-            if len(cmpdata) > _MAX_SIZE :
-                newdata = cmpdata[0:_MAX_SIZE]
-                cmpdata = cmpdata[_MAX_SIZE:]
-            else:
-                newdata = cmpdata
-                cmpdata = b''
-            newdata = dc.decompress(newdata)
-            unprocessed = dc.unconsumed_tail
-            if len(unprocessed) == 0:
-                newdata += dc.flush()
-            data += newdata
-            cmpdata += unprocessed
-            unprocessed = b''
-        return data
+        data = []
+        cmpdata = memoryview(cmpdata)
+        for pos in range(0, len(cmpdata), _MAX_SIZE):
+            data.append(dc.decompress(cmpdata[pos:pos+_MAX_SIZE]))
+        data.append(dc.flush())
+        return b''.join(data)
+
+    def isvalid(self):
+        # check the central directory against the local headers, and the
+        # member data against its CRC and size. an archive that passes
+        # needs no repair and can be used as it is.
+        infolist = self.inzip.infolist()
+        if self.ztype == 'epub':
+            # mimetype must come first, stored, with the right content
+            if not infolist or infolist[0].filename != b'mimetype' \
+                    or infolist[0].compress_type != zipfilerugged.ZIP_STORED \
+                    or self.getfiledata(infolist[0]) != _MIMETYPE.encode('ascii'):
+                return False
+        ranges = []
+        for zi in infolist:
+            if zi.compress_type not in (zipfilerugged.ZIP_STORED, zipfilerugged.ZIP_DEFLATED):
+                return False
+            if not validextra(zi.extra):
+                return False
+            self.bzf.seek(zi.header_offset)
+            fheader = self.bzf.read(_LOCAL_HEADER.size)
+            if len(fheader) != _LOCAL_HEADER.size:
+                return False
+            (magic, version, system, flag_bits, compress_type, time, date,
+                crc, compress_size, file_size, name_length, extra_length) = _LOCAL_HEADER.unpack(fheader)
+            if magic != zipfilerugged.stringFileHeader or compress_type != zi.compress_type:
+                return False
+            if self.bzf.read(name_length) != zi.orig_filename:
+                return False
+            if not validextra(self.bzf.read(extra_length)):
+                return False
+            if not flag_bits & _DATA_DESCRIPTOR and crc != zi.CRC:
+                return False
+            if not flag_bits & _DATA_DESCRIPTOR and compress_size != _ZIP64_SIZE \
+                    and (compress_size, file_size) != (zi.compress_size, zi.file_size):
+                return False
+            start = zi.header_offset + _FILENAME_OFFSET + name_length + extra_length
+            ranges.append((zi.header_offset, start + zi.compress_size))
+            if not zi.flag_bits & 0x01 and not self.checkdata(zi):
+                return False
+        # members must not overlap each other or the central directory
+        ranges.sort()
+        end = 0
+        for start, stop in ranges:
+            if start < end:
+                return False
+            end = stop
+        return end <= self.inzip.start_dir
+
+    def checkdata(self, zi):
+        # True if the member's data has the CRC and size its headers give.
+        # deflated data is inflated for the check and then dropped
+        check = checksum(zi.compress_type)
+        try:
+            for data in self.inzip.readraw(zi):
+                check.update(data)
+            check.finish()
+        except (zlib.error, zipfilerugged.BadZipfile):
+            return False
+        return (check.CRC, check.file_size) == (zi.CRC, zi.file_size)
 
     def getfiledata(self, zi):
         # get file name length and exta data length to find start of file data
@@ -112,9 +232,18 @@ class fixZip:
 
 
     def fix(self):
+        # if nothing needs repairing, copy the archive as it is
+        if self.isvalid():
+            self.bzf.seek(0)
+            with open(self.zoutput, 'wb') as outf:
+                shutil.copyfileobj(self.bzf, outf)
+            self.close()
+            return
+
         # get the zipinfo for each member of the input archive
         # and copy member over to output archive
         # if problems exist with local vs central filename, fix them
+        self.outzip = zipfilerugged.ZipFile(self.zoutput,'w')
 
         # if epub write mimetype file first, with no compression
         if self.ztype == 'epub':
@@ -138,6 +267,14 @@ class fixZip:
         # write the rest of the files
         for zinfo in self.inzip.infolist():
             if zinfo.filename != b"mimetype" or self.ztype != 'epub':
+                compress_type, compresslevel = getpolicy().compression(zinfo.filename)
+                if compress_type == zinfo.compress_type and not zinfo.flag_bits & 0x01 \
+                        and self.checkdata(zinfo):
+                    # the data matches its CRC, so it can be copied as it is,
+                    # under the local name in case that differs from the
+                    # central directory. damaged data is compressed again
+                    self.outzip.copyraw(self.inzip, zinfo, self.getlocalname(zinfo))
+                    continue
                 data = None
                 try:
                     data = self.inzip.read(zinfo.filename)
@@ -154,10 +291,15 @@ class fixZip:
                 nzinfo.external_attr=zinfo.external_attr
                 nzinfo.create_system=zinfo.create_system
                 nzinfo.flag_bits = zinfo.flag_bits & 0x800  # preserve UTF-8 flag
-                self.outzip.writestr(nzinfo,data)
-
-        self.bzf.close()
-        self.inzip.close()
+                # store or deflate it as the policy says, big members in parallel
+                cmpdata = BytesIO()
+                outfile = getpolicy().writer(zinfo.filename, cmpdata)
+                outfile.write(data)
+                outfile.finish()
+                setchecksum(nzinfo, outfile)
+                self.outzip.writeraw(nzinfo, [cmpdata.getvalue()])
+
+        self.close()
         self.outzip.close()
 
 
@@ -168,6 +310,20 @@ def usage():
     """)
 
 
+def checkBook(infile):
+    """
+    True if the archive needs no repair, so it can be used as it is.
+    """
+    try:
+        fr = fixZip(infile)
+    except Exception:
+        return False
+    try:
+        return fr.isvalid()
+    finally:
+        fr.close()
+
+
 def repairBook(infile, outfile):
     if not os.path.exists(infile):
         print("Error: Input Zip File does not exist")
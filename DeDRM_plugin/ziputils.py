@@ -0,0 +1,595 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ziputils.py
+# Copyright © 2021 by Apprentice Harper et al.
+
+# Released under the terms of the GNU General Public Licence, version 3
+# <http://www.gnu.org/licenses/>
+
+# Revision history:
+#   1.0 - Initial release, raw member copy between zip archives
+#   1.1 - Write already deflated data as a member, checksummed on the fly
+#   1.2 - Members can be prepared on worker threads and written out in order
+#   1.3 - Compression policy choosing stored or deflated members by type
+#   1.4 - Deflate large members in parallel blocks, pigz style
+#   1.5 - zlibcompress, for zlib streams through the same parallel deflate
+
+"""
+Helpers shared by the archive rewriting code.
+"""
+
+__license__ = 'GPL v3'
+__version__ = "1.5"
+
+import collections
+import copy
+import functools
+import io
+import os
+import tempfile
+import struct
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+_FILE_HEADER = struct.Struct('<4s2B4HL2L2H')
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+_ZIP64_EXTRA = 0x0001
+_DATA_DESCRIPTOR = 0x08
+_ENCRYPTED = 0x01
+_COPY_SIZE = 1024 * 1024
+_INFLATE_SIZE = 64 * 1024
+# the private attributes of zipfile.ZipFile that raw access needs
+_RAW_ATTRS = ('fp', 'start_dir', '_lock', '_seekable', '_writing', '_writecheck', '_didModify')
+# prepared members are kept in memory up to this size, then spill to disk
+_SPOOL_SIZE = 8 * 1024 * 1024
+
+# number of threads preparing archive members at the same time
+WORKERS = os.cpu_count() or 1
+# members are deflated in blocks of this size on a pool of threads,
+# each primed with the window of data that came before it
+_BLOCK_SIZE = 1024 * 1024
+_WINDOW_SIZE = 32 * 1024
+# files smaller than this aren't worth splitting into blocks
+_PARALLEL_SIZE = 4 * 1024 * 1024
+
+# members whose data is already compressed gain nothing from deflate
+STORED_EXTENSIONS = frozenset((
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.jp2', '.jxr',
+    '.woff', '.woff2',
+    '.mp3', '.m4a', '.m4b', '.aac', '.ogg', '.oga', '.opus',
+    '.mp4', '.m4v', '.webm', '.mov',
+    '.zip', '.gz', '.bz2', '.xz'))
+STORED_MEDIA_TYPES = frozenset((
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/jp2', 'image/vnd.ms-photo',
+    'font/woff', 'font/woff2', 'application/font-woff', 'application/x-font-woff',
+    'audio/mpeg', 'audio/mp4', 'audio/aac', 'audio/ogg', 'audio/opus',
+    'video/mp4', 'video/webm', 'video/quicktime',
+    'application/zip', 'application/gzip'))
+# deflate level used when compression speed matters more than size
+_FAST_LEVEL = 1
+
+
+def stripextra(extra, ids):
+    # remove the given header ids from a zip extra field
+    result = []
+    pos = 0
+    while pos + 4 <= len(extra):
+        xid, xlen = struct.unpack('<HH', extra[pos:pos+4])
+        if xid not in ids:
+            result.append(extra[pos:pos+4+xlen])
+        pos += 4 + xlen
+    return b''.join(result)
+
+
+def rawdataoffset(fp, zinfo):
+    # offset of the compressed data, taken from the local file header
+    fp.seek(zinfo.header_offset)
+    fheader = _FILE_HEADER.unpack(fp.read(_FILE_HEADER.size))
+    if fheader[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header of {0}".format(zinfo.filename))
+    return zinfo.header_offset + _FILE_HEADER.size + fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH]
+
+
+def rawaccess(zf):
+    # raw member access relies on private parts of zipfile.ZipFile, so it
+    # is only used when the running Python's ZipFile still has them all
+    return all(hasattr(zf, name) for name in _RAW_ATTRS)
+
+
+def inflatechunks(chunks, compress_type):
+    # the uncompressed data of a member, given its compressed chunks
+    if compress_type == zipfile.ZIP_STORED:
+        yield from chunks
+        return
+    if compress_type != zipfile.ZIP_DEFLATED:
+        raise NotImplementedError("That compression method is not supported")
+    dc = zlib.decompressobj(-15)
+    for data in chunks:
+        while data:
+            yield dc.decompress(data, _INFLATE_SIZE)
+            data = dc.unconsumed_tail
+    yield dc.flush()
+
+
+def writeplainmember(outzip, zinfo, chunks):
+    """
+    Add a member through the public ZipFile.open interface.
+
+    The uncompressed data is taken from the iterable chunks and
+    compressed as zinfo says, with the CRC and sizes worked out by
+    ZipFile. This is the fallback when raw access isn't available.
+    """
+    zi = copy.copy(zinfo)
+    zi.extra = stripextra(zinfo.extra, (_ZIP64_EXTRA,))
+    with outzip.open(zi, 'w') as outfile:
+        for data in chunks:
+            outfile.write(data)
+    return zi
+
+
+def readraw(inzip, zinfo):
+    # yield the compressed bytes of a member. the file is only touched
+    # under the archive's lock, so other threads can read members meanwhile
+    with inzip._lock:
+        pos = rawdataoffset(inzip.fp, zinfo)
+    remaining = zinfo.compress_size
+    while remaining > 0:
+        with inzip._lock:
+            inzip.fp.seek(pos)
+            data = inzip.fp.read(min(remaining, _COPY_SIZE))
+        if not data:
+            raise EOFError("Truncated data for {0}".format(zinfo.filename))
+        pos += len(data)
+        remaining -= len(data)
+        yield data
+
+
+def writerawmember(outzip, zinfo, chunks, check=None):
+    """
+    Add a member whose compressed data, CRC and sizes are already known.
+
+    The compressed data is taken from the iterable chunks and written
+    to outzip as it is. If check is given the chunks are fed through it
+    too, and the member takes the CRC and sizes it finds, so a member
+    copied from a damaged archive gets headers that match its data.
+    Without raw access to outzip the data is inflated and written by
+    writeplainmember instead.
+    """
+    if not rawaccess(outzip):
+        return writeplainmember(outzip, zinfo, inflatechunks(chunks, zinfo.compress_type))
+    zi = copy.copy(zinfo)
+    zi.flag_bits &= ~_DATA_DESCRIPTOR
+    zi.extra = stripextra(zinfo.extra, (_ZIP64_EXTRA,))
+    zip64 = zi.file_size > zipfile.ZIP64_LIMIT or zi.compress_size > zipfile.ZIP64_LIMIT
+
+    with outzip._lock:
+        if outzip._writing:
+            raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+        if outzip._seekable:
+            outzip.fp.seek(outzip.start_dir)
+        zi.header_offset = outzip.fp.tell()
+        outzip._writecheck(zi)
+        outzip._didModify = True
+        outzip.fp.write(zi.FileHeader(zip64))
+
+        for data in chunks:
+            outzip.fp.write(data)
+            if check is not None:
+                check.update(data)
+
+        outzip.start_dir = outzip.fp.tell()
+        if check is not None:
+            check.finish()
+            if (check.CRC, check.file_size, check.compress_size) != (zi.CRC, zi.file_size, zi.compress_size):
+                # the headers were wrong, write the local one again
+                setchecksum(zi, check)
+                if zip64 != (zi.file_size > zipfile.ZIP64_LIMIT or zi.compress_size > zipfile.ZIP64_LIMIT):
+                    raise zipfile.BadZipFile("Sizes of {0} don't match its headers".format(zi.filename))
+                outzip.fp.seek(zi.header_offset)
+                outzip.fp.write(zi.FileHeader(zip64))
+                outzip.fp.seek(outzip.start_dir)
+        outzip.filelist.append(zi)
+        outzip.NameToInfo[zi.filename] = zi
+    return zi
+
+
+def copyrawmember(inzip, outzip, zinfo):
+    """
+    Copy a member of inzip to outzip without decompressing it.
+
+    The compressed bytes are copied verbatim, so the member is never
+    deflated again. They are inflated on the way past only to check the
+    CRC and sizes, which are corrected if the archive had them wrong.
+    Without raw access to both archives the member is read and written
+    through the public interface instead.
+    """
+    if not (rawaccess(inzip) and rawaccess(outzip)):
+        with inzip.open(zinfo) as infile:
+            return writeplainmember(outzip, zinfo, readchunks(infile))
+    check = None if zinfo.flag_bits & _ENCRYPTED else checksum(zinfo.compress_type)
+    return writerawmember(outzip, zinfo, readraw(inzip, zinfo), check)
+
+
+def setchecksum(zinfo, check):
+    # copy the CRC and sizes gathered while writing a member into its info
+    zinfo.compress_type = check.compress_type
+    zinfo.CRC = check.CRC
+    zinfo.file_size = check.file_size
+    zinfo.compress_size = check.compress_size
+
+
+class DeflateChecksum(object):
+    """
+    CRC-32 and sizes of a raw deflate stream that is fed in pieces.
+
+    The stream is inflated only to compute the CRC and the uncompressed
+    size; the inflated bytes are dropped straight away. finish() raises
+    zlib.error unless the data was a single complete deflate stream.
+    """
+    compress_type = zipfile.ZIP_DEFLATED
+
+    def __init__(self):
+        self.dc = zlib.decompressobj(-15)
+        self.CRC = 0
+        self.file_size = 0
+        self.compress_size = 0
+
+    def checksum(self, data):
+        self.CRC = zlib.crc32(data, self.CRC)
+        self.file_size += len(data)
+
+    def update(self, data):
+        self.compress_size += len(data)
+        while data:
+            self.checksum(self.dc.decompress(data, _INFLATE_SIZE))
+            data = self.dc.unconsumed_tail
+
+    def finish(self):
+        self.checksum(self.dc.flush())
+        if not self.dc.eof or self.dc.unused_data:
+            raise zlib.error("Not a complete deflate stream")
+
+
+class StoredChecksum(object):
+    """
+    CRC-32 and sizes of stored member data that is fed in pieces.
+    """
+    compress_type = zipfile.ZIP_STORED
+
+    def __init__(self):
+        self.CRC = 0
+        self.file_size = 0
+        self.compress_size = 0
+
+    def update(self, data):
+        self.CRC = zlib.crc32(data, self.CRC)
+        self.file_size += len(data)
+        self.compress_size += len(data)
+
+    def finish(self):
+        pass
+
+
+def checksum(compress_type):
+    # a DeflateChecksum or StoredChecksum for member data of compress_type,
+    # None for the methods that can't be checked here
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return DeflateChecksum()
+    if compress_type == zipfile.ZIP_STORED:
+        return StoredChecksum()
+    return None
+
+
+class DeflateWriter(object):
+    """
+    Raw deflate whatever is written into fileobj, keeping the CRC-32 and
+    sizes needed for the member's headers.
+    """
+    compress_type = zipfile.ZIP_DEFLATED
+
+    def __init__(self, fileobj, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.fileobj = fileobj
+        self.co = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.CRC = 0
+        self.file_size = 0
+        self.compress_size = 0
+
+    def write(self, data):
+        self.CRC = zlib.crc32(data, self.CRC)
+        self.file_size += len(data)
+        self.emit(self.co.compress(data))
+        return len(data)
+
+    def emit(self, data):
+        self.fileobj.write(data)
+        self.compress_size += len(data)
+
+    def finish(self):
+        self.emit(self.co.flush())
+
+
+def _gf2_times(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_square(mat):
+    return [_gf2_times(mat, mat[n]) for n in range(32)]
+
+
+@functools.lru_cache(maxsize=8)
+def _crc32_zeros(length):
+    # the operator that runs a CRC-32 on over length zero bytes, as in
+    # zlib's crc32_combine. blocks are mostly the same size, so it's cached.
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    op = None
+    bit = _gf2_square(_gf2_square(_gf2_square(odd)))
+    while length:
+        if length & 1:
+            op = bit if op is None else [_gf2_times(bit, row) for row in op]
+        length >>= 1
+        if length:
+            bit = _gf2_square(bit)
+    return op
+
+
+def crc32_combine(crc1, crc2, len2):
+    """
+    CRC-32 of two pieces of data joined, given the CRC of each and the
+    length of the second.
+    """
+    if len2 <= 0:
+        return crc1
+    return _gf2_times(_crc32_zeros(len2), crc1) ^ crc2
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _pool():
+    # threads shared by all the parallel deflate writers
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS)
+    return _executor
+
+
+def _deflateblock(block, window, level, flush):
+    if window:
+        co = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=window)
+    else:
+        co = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return co.compress(block) + co.flush(flush), zlib.crc32(block), len(block)
+
+
+class ParallelDeflateWriter(object):
+    """
+    Raw deflate whatever is written into fileobj, like DeflateWriter, but
+    a block at a time on a pool of threads, as pigz does.
+
+    Each block is deflated on its own, primed with the 32K of data before
+    it and ended with a sync flush, so the blocks join up into a single
+    deflate stream that any zip reader can inflate. Their CRCs are joined
+    with crc32_combine. Data that fits in one block is deflated in place.
+    """
+    compress_type = zipfile.ZIP_DEFLATED
+
+    def __init__(self, fileobj, level=zlib.Z_DEFAULT_COMPRESSION, blocksize=_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.blocksize = blocksize
+        self.buffer = []
+        self.buffered = 0
+        self.window = b''
+        self.pending = collections.deque()
+        self.CRC = 0
+        self.file_size = 0
+        self.compress_size = 0
+
+    def write(self, data):
+        count = len(data)
+        self.buffer.append(bytes(data))
+        self.buffered += count
+        if self.buffered >= self.blocksize:
+            data = b''.join(self.buffer)
+            pos = 0
+            while len(data) - pos >= self.blocksize:
+                self.submit(data[pos:pos+self.blocksize], zlib.Z_SYNC_FLUSH)
+                pos += self.blocksize
+            self.buffer = [data[pos:]]
+            self.buffered = len(data) - pos
+        return count
+
+    def submit(self, block, flush):
+        self.pending.append(_pool().submit(_deflateblock, block, self.window, self.level, flush))
+        self.window = block[-_WINDOW_SIZE:]
+        # keep a bounded number of blocks in memory
+        while len(self.pending) > 2 * WORKERS:
+            self.emit(*self.pending.popleft().result())
+
+    def emit(self, data, crc, size):
+        self.fileobj.write(data)
+        self.compress_size += len(data)
+        self.CRC = crc32_combine(self.CRC, crc, size)
+        self.file_size += size
+
+    def finish(self):
+        block = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if not self.window:
+            # nothing was handed to the pool, so there's just the one block
+            self.emit(*_deflateblock(block, b'', self.level, zlib.Z_FINISH))
+            return
+        self.submit(block, zlib.Z_FINISH)
+        while self.pending:
+            self.emit(*self.pending.popleft().result())
+
+
+class StoredWriter(object):
+    """
+    Pass whatever is written into fileobj through uncompressed, keeping
+    the CRC-32 and sizes needed for the member's headers.
+    """
+    compress_type = zipfile.ZIP_STORED
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.CRC = 0
+        self.file_size = 0
+        self.compress_size = 0
+
+    def write(self, data):
+        self.CRC = zlib.crc32(data, self.CRC)
+        self.fileobj.write(data)
+        self.file_size += len(data)
+        self.compress_size += len(data)
+        return len(data)
+
+    def finish(self):
+        pass
+
+
+class CompressionPolicy(object):
+    """
+    Decide how each member of a rewritten archive is compressed.
+
+    The EPUB mimetype entry and members that are already compressed
+    (JPEG, PNG, WOFF, MP3, MP4 and the like) are stored, judged by media
+    type when the caller knows it and by file extension otherwise.
+    Everything else is deflated, at the fastest level in fast mode and
+    at the default level otherwise.
+    """
+    def __init__(self, fast=False):
+        self.fast = fast
+        self.level = _FAST_LEVEL if fast else zlib.Z_DEFAULT_COMPRESSION
+
+    def isstored(self, name, media_type=None):
+        if name in ('mimetype', b'mimetype'):
+            # EPUB requires the mimetype entry to be stored
+            return True
+        if media_type:
+            return media_type.split(';')[0].strip().lower() in STORED_MEDIA_TYPES
+        if isinstance(name, bytes):
+            name = name.decode('utf-8', 'replace')
+        return os.path.splitext(name)[1].lower() in STORED_EXTENSIONS
+
+    def compression(self, name, media_type=None):
+        # (compress_type, compresslevel) for the member called name
+        if self.isstored(name, media_type):
+            return zipfile.ZIP_STORED, None
+        return zipfile.ZIP_DEFLATED, self.level
+
+    def apply(self, zinfo, media_type=None):
+        # set up zinfo for ZipFile.open(zinfo, 'w')
+        zinfo.compress_type, zinfo._compresslevel = self.compression(zinfo.filename, media_type)
+        return zinfo
+
+    def writer(self, name, fileobj, media_type=None):
+        # a StoredWriter or ParallelDeflateWriter into fileobj for the member called name
+        compress_type, level = self.compression(name, media_type)
+        if compress_type == zipfile.ZIP_STORED:
+            return StoredWriter(fileobj)
+        return ParallelDeflateWriter(fileobj, level)
+
+
+_policy = CompressionPolicy()
+
+
+def getpolicy():
+    # the compression policy used by all archive writers
+    return _policy
+
+
+def setpolicy(policy):
+    global _policy
+    _policy = policy
+
+
+def zlibcompress(data, level=None):
+    """
+    Compress data in the zlib format, as PDF's FlateDecode wants it,
+    with the deflating done by ParallelDeflateWriter at the policy's
+    level unless another is given.
+    """
+    if level is None:
+        level = getpolicy().level
+    out = io.BytesIO()
+    out.write(b'\x78\x9c')
+    check = ParallelDeflateWriter(out, level)
+    check.write(data)
+    check.finish()
+    out.write(struct.pack('>L', zlib.adler32(data)))
+    return out.getvalue()
+
+
+def spoolfile():
+    return tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+
+
+def readchunks(fileobj):
+    return iter(lambda: fileobj.read(_COPY_SIZE), b'')
+
+
+def writefile(outzip, filename, arcname):
+    """
+    Add a file from disk to outzip, compressed as the policy says.
+
+    Large files that are to be deflated go through ParallelDeflateWriter,
+    anything else is left to ZipFile.write.
+    """
+    compress_type, level = getpolicy().compression(arcname)
+    if compress_type == zipfile.ZIP_STORED or os.path.getsize(filename) < _PARALLEL_SIZE:
+        outzip.write(filename, arcname, compress_type, level)
+        return
+    zi = zipfile.ZipInfo.from_file(filename, arcname)
+    with spoolfile() as spool:
+        check = ParallelDeflateWriter(spool, level)
+        with open(filename, 'rb') as fh:
+            for data in readchunks(fh):
+                check.write(data)
+        check.finish()
+        setchecksum(zi, check)
+        spool.seek(0)
+        writerawmember(outzip, zi, readchunks(spool))
+
+
+class MemberSlice(object):
+    """
+    Seekable read-only view of a byte range within an open zip member.
+    """
+    def __init__(self, fh, start, length):
+        self.fh = fh
+        self.start = start
+        self.end = start + length
+        self.fh.seek(start)
+
+    def tell(self):
+        return self.fh.tell() - self.start
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.tell()
+        elif whence == os.SEEK_END:
+            offset += self.end - self.start
+        self.fh.seek(self.start + min(max(offset, 0), self.end - self.start))
+        return self.tell()
+
+    def read(self, count=-1):
+        remaining = self.end - self.fh.tell()
+        if count < 0 or count > remaining:
+            count = remaining
+        return self.fh.read(count)
@@ -32,7 +32,7 @@ from calibre_plugins.obok_dedrm.utilities import (
                             debug_print
                             )
 
-from calibre_plugins.obok_dedrm.obok.obok import KoboLibrary
+from calibre_plugins.obok_dedrm.obok.obok import KoboLibrary, compression
 from calibre_plugins.obok_dedrm.obok.legacy_obok import legacy_obok
 
 PLUGIN_ICONS = ['images/obok.png']
@@ -392,13 +392,15 @@ class InterfacePluginAction(InterfaceAction):
                 # end of mimetype mod
                 for filename in members:
                     contents = zin.read(filename)
+                    mimetype = None
                     if filename in book.encryptedfiles:
                         file = book.encryptedfiles[filename]
                         contents = file.decrypt(userkey, contents)
                         # Parse failures mean the key is probably wrong.
                         if check:
                             check = not file.check(contents)
-                    zout.writestr(filename, contents)
+                        mimetype = file.mimetype
+                    zout.writestr(filename, contents, *compression(filename, mimetype, cfg['fast_compression']))
                 zout.close()
                 zin.close()
                 result['success'] = True
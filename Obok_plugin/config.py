@@ -3,7 +3,7 @@
 
 # vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
 
-from PyQt5.Qt import (Qt, QGroupBox, QListWidget, QLineEdit, QDialogButtonBox, QWidget, QLabel, QDialog, QVBoxLayout, QAbstractItemView, QIcon, QHBoxLayout, QComboBox, QListWidgetItem, QFileDialog)
+from PyQt5.Qt import (Qt, QGroupBox, QListWidget, QLineEdit, QDialogButtonBox, QWidget, QLabel, QDialog, QVBoxLayout, QAbstractItemView, QIcon, QHBoxLayout, QComboBox, QListWidgetItem, QFileDialog, QCheckBox)
 from PyQt5 import Qt as QtGui
 
 from calibre.gui2 import (error_dialog, question_dialog, info_dialog, open_url)
@@ -13,6 +13,8 @@ plugin_prefs = JSONConfig('plugins/obok_dedrm_prefs')
 plugin_prefs.defaults['finding_homes_for_formats'] = 'Ask'
 plugin_prefs.defaults['kobo_serials'] = []
 plugin_prefs.defaults['kobo_directory'] = u''
+# store media and deflate at the fastest level when writing decrypted books
+plugin_prefs.defaults['fast_compression'] = False
 
 from calibre_plugins.obok_dedrm.__init__ import PLUGIN_NAME, PLUGIN_VERSION
 from calibre_plugins.obok_dedrm.utilities import (debug_print)
@@ -55,6 +57,11 @@ class ConfigWidget(QWidget):
         self.kobo_directory_button.clicked.connect(self.edit_kobo_directory)
         layout.addWidget(self.kobo_directory_button)
 
+        self.fast_compression_checkbox = QCheckBox(_("Compress decrypted books faster, making larger files"), self)
+        self.fast_compression_checkbox.setToolTip(_("Deflate the members of decrypted EPUBs at the fastest level"))
+        self.fast_compression_checkbox.setChecked(plugin_prefs['fast_compression'])
+        layout.addWidget(self.fast_compression_checkbox)
+
 
     def edit_serials(self):
         d = ManageKeysDialog(self,"Kobo device serial number",self.tmpserials, AddSerialDialog)
@@ -72,6 +79,7 @@ class ConfigWidget(QWidget):
         plugin_prefs['finding_homes_for_formats'] = self.find_homes.currentText()
         plugin_prefs['kobo_serials'] = self.tmpserials
         plugin_prefs['kobo_directory'] = self.kobodirectory
+        plugin_prefs['fast_compression'] = self.fast_compression_checkbox.isChecked()
 
 
 
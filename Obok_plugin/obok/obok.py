@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+# Version 4.1.1 February 2021
+# Store already compressed media in decrypted books, with a fast mode
+#
 # Version 4.1.0 February 2021
 # Add detection for Kobo directory location on Linux
 
@@ -176,6 +179,18 @@ import shutil
 import argparse
 import tempfile
 
+# the compression policy is shared with the DeDRM plugin, whose ziputils
+# is copied in beside this file for a release
+try:
+    from ziputils import CompressionPolicy
+except ImportError:
+    try:
+        from calibre_plugins.obok_dedrm.obok.ziputils import CompressionPolicy
+    except ImportError:
+        # running from the source tree
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'DeDRM_plugin'))
+        from ziputils import CompressionPolicy
+
 can_parse_xml = True
 try:
   from xml.etree import ElementTree as ET
@@ -708,7 +723,16 @@ class KoboFile(object):
             contents = contents[:-padding]
         return contents
 
-def decrypt_book(book, lib):
+def compression(filename, mimetype=None, fast=False):
+    """
+    The compress_type and compresslevel for a member of a decrypted book.
+
+    The mimetype entry and already compressed media are stored, everything
+    else is deflated, at the fastest level if fast is set, as the DeDRM
+    plugin's CompressionPolicy decides."""
+    return CompressionPolicy(fast).compression(filename, mimetype)
+
+def decrypt_book(book, lib, fast=False):
     print("Converting {0}".format(book.title))
     zin = zipfile.ZipFile(book.filename, "r")
     # make filename out of Unicode alphanumeric and whitespace equivalents from title
@@ -725,12 +749,14 @@ def decrypt_book(book, lib):
             zout = zipfile.ZipFile(outname, "w", zipfile.ZIP_DEFLATED)
             for filename in zin.namelist():
                 contents = zin.read(filename)
+                mimetype = None
                 if filename in book.encryptedfiles:
                     file = book.encryptedfiles[filename]
                     contents = file.decrypt(userkey, contents)
                     # Parse failures mean the key is probably wrong.
                     file.check(contents)
-                zout.writestr(filename, contents)
+                    mimetype = file.mimetype
+                zout.writestr(filename, contents, *compression(filename, mimetype, fast))
             zout.close()
             print("Decryption succeeded.")
             print("Book saved as {0}".format(os.path.join(os.getcwd(), outname)))
@@ -750,6 +776,7 @@ def cli_main():
     parser = argparse.ArgumentParser(prog=sys.argv[0], description=description, epilog=epilog)
     parser.add_argument('--devicedir', default='/media/KOBOeReader', help="directory of connected Kobo device")
     parser.add_argument('--all', action='store_true', help="flag for converting all books on device")
+    parser.add_argument('--fast', action='store_true', help="flag for compressing output faster, with larger files")
     args = vars(parser.parse_args())
     serials = []
     devicedir = u""
@@ -776,7 +803,7 @@ def cli_main():
                 print("Invalid choice. Exiting...")
                 exit()
 
-    results = [decrypt_book(book, lib) for book in books]
+    results = [decrypt_book(book, lib, args['fast']) for book in books]
     lib.close()
     overall_result = all(result != 0 for result in results)
     if overall_result != 0:
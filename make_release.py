@@ -17,6 +17,7 @@ DEDRM_SRC_DIR = 'DeDRM_plugin'
 DEDRM_README= 'DeDRM_plugin_ReadMe.txt'
 OBOK_SRC_DIR = 'Obok_plugin'
 OBOK_README = 'obok_plugin_ReadMe.txt'
+SHARED_ZIPUTILS = 'ziputils.py'
 RELEASE_DIR = 'release'
 
 
@@ -27,7 +28,12 @@ def make_release(version):
         pass
     os.mkdir(RELEASE_DIR)
     shutil.make_archive(DEDRM_SRC_DIR, 'zip', DEDRM_SRC_DIR)
-    shutil.make_archive(OBOK_SRC_DIR, 'zip', OBOK_SRC_DIR)
+    # Obok uses the DeDRM plugin's ziputils, so a copy goes into its zip
+    obok_dir = os.path.join(RELEASE_DIR, OBOK_SRC_DIR)
+    shutil.copytree(OBOK_SRC_DIR, obok_dir)
+    shutil.copy(os.path.join(DEDRM_SRC_DIR, SHARED_ZIPUTILS), os.path.join(obok_dir, 'obok'))
+    shutil.make_archive(OBOK_SRC_DIR, 'zip', obok_dir)
+    shutil.rmtree(obok_dir)
     shutil.move(DEDRM_SRC_DIR+'.zip', RELEASE_DIR)
     shutil.move(OBOK_SRC_DIR+'.zip', RELEASE_DIR)
     shutil.copy(DEDRM_README, RELEASE_DIR)